@@ -0,0 +1,555 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the overhead of virt-test-ci itself.
+
+Libvirt, mounts, directories and ./run are simulated, so benchmarks
+never touch the host.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import string
+import resource
+import optparse
+import tempfile
+import subprocess
+import ci
+
+
+def legacy_sanitize_log(log):
+    """
+    Log filter used by Report.update() before sanitize_log().
+    """
+    return ''.join(s for s in unicode(log, errors='ignore')
+                   if s in string.printable)
+
+
+def make_log(size, seed=0):
+    """
+    Generate a log of _size_ bytes like verbose ./run output, with some
+    XML, control characters and non ASCII bytes.
+    """
+    rand = random.Random(seed)
+    chars = string.ascii_letters + string.digits + " _-.:/'"
+    lines = []
+    length = 0
+    while length < size:
+        line = '%02d:%02d:%02d DEBUG| Running \'virsh domname vm1\' %s' % (
+            rand.randint(0, 23), rand.randint(0, 59), rand.randint(0, 59),
+            ''.join(rand.choice(chars) for _ in range(40)))
+        if rand.random() < 0.1:
+            line += ' <source file="/var/lib/libvirt/images/a.qcow2"/>'
+        if rand.random() < 0.05:
+            line += '\x1b[1;31m\xe2\x9c\x93\x00'
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines)[:size]
+
+
+def measure(func, *args):
+    """
+    Return best time of calling func(*args) three times.
+    """
+    best = None
+    for _ in range(3):
+        start = time.time()
+        func(*args)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def measure_each(func, count):
+    """
+    Return best time of calling func() _count_ times, divided by _count_.
+    """
+    return measure(lambda: [func() for _ in range(count)]) / count
+
+
+def bench_sanitize(size_mb):
+    """
+    Compare throughput of the log sanitizer on a large log.
+    """
+    log = make_log(int(size_mb * 1024 * 1024))
+    if legacy_sanitize_log(log) != ci.sanitize_log(log):
+        raise Exception('sanitize_log() differs from legacy filter')
+    lines = log.splitlines()
+
+    print 'Sanitizing %.1f MB log' % size_mb
+    results = {}
+    for name, func, arg in [
+            ('legacy sanitize', legacy_sanitize_log, log),
+            ('sanitize_log', ci.sanitize_log, log),
+            ('escape_str', lambda ls: [ci.escape_str(l) for l in ls],
+             lines)]:
+        duration = measure(func, arg)
+        print '  %-16s %8.3f s %10.1f MB/s' % (name, duration,
+                                               size_mb / duration)
+        results['sanitize: %s' % name] = duration
+    return results
+
+
+def make_connection(domains):
+    """
+    Return a fake libvirt connection with _domains_ domains and a pool
+    holding a volume for each of them.
+    """
+    doms = []
+    vols = []
+    for idx in range(domains):
+        name = 'vm%d' % idx
+        xml = ['<domain type="kvm">', '  <name>%s</name>' % name]
+        xml += ['  <!-- device %d of %s -->' % (line, name)
+                for line in range(200)]
+        xml.append('</domain>')
+        doms.append(ci.FakeLibvirtObject(
+            info=[5, 1048576, 1048576, 2, 0], isActive=0, ID=-1, name=name,
+            UUIDString='%08d-0000-0000-0000-000000000000' % idx,
+            OSType='hvm', isPersistent=1, autostart=0,
+            hasManagedSaveImage=0, XMLDesc='\n'.join(xml)))
+        vols.append(ci.FakeLibvirtObject(
+            name='%s.qcow2' % name, path='/images/%s.qcow2' % name))
+    pool = ci.FakeLibvirtObject(
+        info=[2, 10737418240, 1073741824, 9663676416], isActive=1,
+        name='default', UUIDString='3e4d7a5b-1c4e-4d6f-8a2b-6c0d3f4e5a6b',
+        isPersistent=1, autostart=1, listAllVolumes=vols,
+        XMLDesc='<pool type="dir">\n</pool>\n')
+    return ci.FakeLibvirtConnection(domains=doms, pools=[pool])
+
+
+def legacy_items(state):
+    """
+    Return a copy of a state with items as plain dicts and lists, like
+    states were kept before state item records.
+    """
+    return dict((name, dict((key, list(value) if type(value) is tuple
+                             else value) for key, value in info.items()))
+                for name, info in state.items())
+
+
+def legacy_update(report, testname, ts_name, log, duration):
+    """
+    Add a test case keeping its full log, like Report.update() did
+    before test result records.
+    """
+    tc = ci.Report.testcaseType()
+    tc.name = testname
+    tc.time = duration
+    tc.system_out = ci.sanitize_log(log)
+    if ts_name not in report.ts_dict:
+        ts = ci.Report.testsuite(name=ts_name)
+        ts.failures = ts.skips = ts.tests = ts.errors = 0
+        report.ts_dict[ts_name] = ts
+    ts = report.ts_dict[ts_name]
+    ts.add_testcase(tc)
+    ts.tests += 1
+
+
+def memory_run(mode, tests, domains, log_size):
+    """
+    Run a synthetic CI run in _mode_ 'legacy' or 'compact' and print
+    the peak RSS of the process in KiB.
+    """
+    conn = make_connection(domains)
+    snapshot = ci.LibvirtSnapshot(connect=lambda uri: conn)
+    states = [ci.DomainState(), ci.PoolState()]
+    for state in states:
+        state.snapshot = snapshot
+        state.backup()
+        if mode == 'legacy':
+            state.backup_state = legacy_items(state.backup_state)
+    report = ci.Report()
+    logs = [make_log(log_size, seed) for seed in range(10)]
+    for idx in range(tests):
+        # Some tests leave a changed domain behind
+        dom = conn.domains[idx % domains]
+        dom.props['autostart'] = idx % 7 == 0
+        for state in states:
+            state.check(recover=False)
+            if mode == 'legacy':
+                state.current_state = legacy_items(state.current_state)
+                state.last_state = state.current_state
+        testname = 'virsh.test%d.default' % idx
+        ts_name = 'virsh.test%d' % (idx % 100)
+        log = logs[idx % len(logs)] + testname
+        if mode == 'legacy':
+            legacy_update(report, testname, ts_name, log, 1.0)
+        else:
+            report.update(testname, ts_name, 'PASS', log, [], 1.0)
+    report.save(os.devnull)
+    print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_memory(tests, domains, log_size):
+    """
+    Compare peak RSS of synthetic runs, each in a fresh process.
+    """
+    print 'Peak RSS of %d tests with %d domains and %d KiB logs' % (
+        tests, domains, log_size / 1024)
+    results = {}
+    for mode in ('legacy', 'compact'):
+        out = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__),
+             '--memory-mode', mode, '--tests', str(tests),
+             '--domains', str(domains), '--log-size', str(log_size / 1024)])
+        print '  %-16s %8.1f MiB' % (mode, int(out.split()[-1]) / 1024.0)
+        results['memory: %s' % mode] = int(out.split()[-1])
+    return results
+
+
+class FakeVirsh():
+
+    """
+    Stand-in of virttest.virsh answering like virsh on a host with
+    _domains_ domains, _pools_ pools with _volumes_ volumes each and
+    _secrets_ secrets. Every domain XML has _xml_lines_ lines.
+    """
+
+    def __init__(self, domains, pools, volumes, secrets, xml_lines=200):
+        self.domains = ['vm%d' % idx for idx in range(domains)]
+        self.pools = ['pool%d' % idx for idx in range(pools)]
+        self.volumes = volumes
+        self.secrets = ['%08d-1111-2222-3333-444444444444' % idx
+                        for idx in range(secrets)]
+        self.xml_lines = xml_lines
+
+    def result(self, stdout):
+        return ci.utils.CmdResult('virsh', stdout, '', 0, 0)
+
+    def table(self, rows):
+        return self.result('\n'.join([' Name    State', '-' * 20] + rows))
+
+    def dom_list(self, options=''):
+        return self.result('\n'.join(self.domains))
+
+    def dominfo(self, name):
+        return self.result(
+            'Id:             -\nName:           %s\n'
+            'UUID:           %s\nOS Type:        hvm\n'
+            'State:          shut off\nCPU(s):         2\n'
+            'Max memory:     1048576 KiB\nUsed memory:    1048576 KiB\n'
+            'Persistent:     yes\nAutostart:      disable\n'
+            'Managed save:   no\nSecurity model: none\n'
+            'Security DOI:   0\n' % (name, name.ljust(36, '0')))
+
+    def dumpxml(self, name, extra=''):
+        xml = ['<domain type="kvm">', '  <name>%s</name>' % name]
+        xml += ['  <!-- device %d of %s -->' % (line, name)
+                for line in range(self.xml_lines)]
+        xml.append('</domain>')
+        return self.result('\n'.join(xml) + '\n')
+
+    def net_list(self, options=''):
+        return self.table(['default active yes yes'])
+
+    def net_info(self, name):
+        return self.result('Name: %s\nUUID: %s\nActive: yes\n'
+                           'Persistent: yes\nAutostart: yes\n'
+                           'Bridge: virbr0\n' % (name, name.ljust(36, '0')))
+
+    def net_dumpxml(self, name, extra=''):
+        return self.result('<network>\n  <name>%s</name>\n</network>\n'
+                           % name)
+
+    def pool_list(self, options=''):
+        return self.table(['%s active yes' % name for name in self.pools])
+
+    def pool_info(self, name):
+        return self.result(
+            'Name:           %s\nUUID:           %s\n'
+            'State:          running\nPersistent:     yes\n'
+            'Autostart:      yes\nCapacity:       10.00 GiB\n'
+            'Allocation:     1.00 GiB\nAvailable:      9.00 GiB\n'
+            % (name, name.ljust(36, '0')))
+
+    def pool_dumpxml(self, name, extra=''):
+        return '<pool type="dir">\n  <name>%s</name>\n</pool>\n' % name
+
+    def vol_list(self, name):
+        return self.table(['vol%d.qcow2 /images/%s/vol%d.qcow2' % (
+            idx, name, idx) for idx in range(self.volumes)])
+
+    def secret_list(self):
+        return self.table(['%s  secret' % uuid for uuid in self.secrets])
+
+    def secret_dumpxml(self, uuid):
+        return self.result('<secret>\n  <uuid>%s</uuid>\n</secret>\n' %
+                           uuid)
+
+
+FAKE_RUN = """#!%(python)s
+import sys
+import time
+if '--list-tests' in sys.argv:
+    print 'Searching for tests...'
+    for idx in range(%(tests)d):
+        if idx %% 4 == 3:
+            name = 'svirt.case%%d.default' %% idx
+        else:
+            name = 'virsh.cmd%%d.variant%%d' %% (idx / 3, idx %% 3)
+        print '%%d type_specific.io-github-autotest-libvirt.%%s (requires root)' %% (
+            idx + 1, name)
+    sys.exit(0)
+tests = sys.argv[sys.argv.index('--tests') + 1].split(',')
+line = time.strftime('%%H:%%M:%%S') + ' DEBUG| ' + 'x' * 60 + '\\n'
+for idx, test in enumerate(tests):
+    sys.stdout.write(line * (%(output_size)d / len(line)))
+    print 'JOB LOG: /tmp/job.log'
+    print '(%%d/%%d) %%s: PASS (1.00 s)' %% (idx + 1, len(tests), test)
+"""
+
+
+def make_root(root, tests, output_size):
+    """
+    Create a fake virt-test root with a ./run listing _tests_ tests and
+    printing _output_size_ bytes for each test run.
+    """
+    run = os.path.join(root, 'run')
+    with open(run, 'w') as fp:
+        fp.write(FAKE_RUN % {'python': sys.executable, 'tests': tests,
+                             'output_size': output_size})
+    os.chmod(run, 0755)
+
+
+class BenchDirState(ci.DirState):
+
+    def __init__(self, top, **kwargs):
+        ci.DirState.__init__(self, **kwargs)
+        self.top = top
+
+    def get_names(self):
+        return [self.top]
+
+
+class BenchFileState(ci.FileState):
+
+    def __init__(self, files):
+        self.files = files
+
+    def get_names(self):
+        return self.files
+
+
+def make_mountinfo(path, mounts):
+    """
+    Write a mountinfo table with _mounts_ nested mount points.
+    """
+    with open(path, 'w') as fp:
+        fp.write('1 0 253:0 / / rw,relatime shared:1 - xfs /dev/root rw\n')
+        for idx in range(mounts):
+            parent = 1 if idx % 10 == 0 else idx - idx % 10 + 2
+            point = '/mnt/m%d' % (idx - idx % 10)
+            if idx % 10:
+                point += '/sub%d' % idx
+            fp.write('%d %d 0:%d / %s rw shared:%d - tmpfs tmpfs rw,size=1k\n'
+                     % (idx + 2, parent, idx + 40, point, idx + 2))
+
+
+def make_tree(top, entries):
+    """
+    Create a directory tree with _entries_ files in directories of 100.
+    """
+    for idx in range(entries):
+        dirname = os.path.join(top, 'd%d' % (idx / 100))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, 'f%d' % idx), 'w') as fp:
+            fp.write('%d\n' % idx)
+
+
+def bench_harness(opts):
+    """
+    Measure per test overhead of the harness: state checks, report
+    updates and saving, listing tests and splitting names.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='virt-test-ci-bench-')
+    cwd = os.getcwd()
+    virsh = ci.virsh
+    mountinfo = ci.MountState.mountinfo
+    argv = sys.argv
+    results = {}
+    try:
+        ci.virsh = FakeVirsh(opts.domains, opts.pools, opts.volumes,
+                             opts.secrets)
+        ci.MountState.mountinfo = os.path.join(tmp_dir, 'mountinfo')
+        make_mountinfo(ci.MountState.mountinfo, opts.mounts)
+        tree = os.path.join(tmp_dir, 'tree')
+        make_tree(tree, opts.dir_entries)
+        files = []
+        for idx in range(3):
+            files.append(os.path.join(tmp_dir, 'file%d.conf' % idx))
+            with open(files[-1], 'w') as fp:
+                fp.write('key%d = value\n' % idx * 100)
+        conn = make_connection(opts.domains)
+        api_states = [ci.DomainState(), ci.PoolState()]
+        snapshot = ci.LibvirtSnapshot(connect=lambda uri: conn)
+        for state in api_states:
+            state.snapshot = snapshot
+
+        print ('State.check() of %d domains, %d pools of %d volumes, '
+               '%d secrets, %d mounts, %d files' % (
+                   opts.domains, opts.pools, opts.volumes, opts.secrets,
+                   opts.mounts, opts.dir_entries))
+        states = [
+            ('domain', ci.DomainState()),
+            ('domain (api)', api_states[0]),
+            ('network', ci.NetworkState()),
+            ('pool', ci.PoolState()),
+            ('pool (api)', api_states[1]),
+            ('secret', ci.SecretState()),
+            ('mount', ci.MountState()),
+            ('directory', BenchDirState(tree)),
+            ('directory (deep)', BenchDirState(tree, recursive=True)),
+            ('file', BenchFileState(files))]
+        for name, state in states:
+            state.backup()
+            duration = measure_each(state.check, 10)
+            print '  %-24s %10.3f ms' % (name, duration * 1000)
+            results['check: %s' % name] = duration
+
+        tests = ['type_specific.io-github-autotest-libvirt.virsh.cmd%d.'
+                 'variant%d' % (idx / 3, idx % 3) for idx in range(opts.tests)]
+        logs = [make_log(opts.log_size, seed) for seed in range(10)]
+        for journal in (None, os.path.join(tmp_dir, 'report.journal')):
+            def update():
+                report = ci.Report(journal=journal)
+                if journal:
+                    open(journal, 'w').close()
+                for idx, test in enumerate(tests):
+                    report.update(test, test.split('.')[3], 'PASS',
+                                  logs[idx % len(logs)], [], 1.0)
+                return report
+            mode = 'journal' if journal else 'memory'
+            print 'Report of %d tests with %d KiB logs (%s)' % (
+                len(tests), opts.log_size / 1024, mode)
+            duration = measure(update) / len(tests)
+            print '  %-24s %10.3f ms' % ('update', duration * 1000)
+            results['report update: %s' % mode] = duration
+            report = update()
+            duration = measure(report.save, os.path.join(
+                tmp_dir, 'report.xml')) / len(tests)
+            print '  %-24s %10.3f ms' % ('save', duration * 1000)
+            results['report save: %s' % mode] = duration
+
+        root = os.path.join(tmp_dir, 'root')
+        os.mkdir(root)
+        make_root(root, opts.tests, opts.log_size)
+        os.chdir(root)
+        sys.argv = ['ci.py', '--cache-dir', os.path.join(tmp_dir, 'cache')]
+        lci = ci.LibvirtCI()
+        lci.parse_args()
+        lci.root_dir = root
+        lci.history = ci.TestHistory(os.path.join(tmp_dir, 'history.json'))
+        print 'Per test overhead of listing %d tests' % opts.tests
+        for name, no_cache in [('prepare_tests', True),
+                               ('prepare_tests (cached)', False)]:
+            lci.args.no_list_cache = no_cache
+            listed = lci.prepare_tests()
+            duration = measure(lci.prepare_tests) / len(listed)
+            print '  %-24s %10.3f ms' % (name, duration * 1000)
+            results[name] = duration
+        duration = measure(
+            lambda: [lci.split_name(test) for test in listed]) / len(listed)
+        print '  %-24s %10.3f ms' % ('split_name', duration * 1000)
+        results['split_name'] = duration
+    finally:
+        os.chdir(cwd)
+        sys.argv = argv
+        ci.virsh = virsh
+        ci.MountState.mountinfo = mountinfo
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def compare_baseline(results, baseline, tolerance):
+    """
+    Compare results with a baseline saved by --save.
+
+    :return: Names of benchmarks slower than _tolerance_ times baseline.
+    """
+    with open(baseline) as fp:
+        base = json.load(fp)
+    print 'Compared with baseline %s' % baseline
+    regressions = []
+    for name in sorted(results):
+        if not base.get(name):
+            continue
+        ratio = results[name] / base[name]
+        mark = ''
+        if ratio > tolerance:
+            mark = ' REGRESSION'
+            regressions.append(name)
+        print '  %-32s %6.2fx%s' % (name, ratio, mark)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(
+        description='Benchmarks of virt-test-ci harness overhead.')
+    parser.add_option('--size', dest='size', action='store', default='8',
+                      help='Size in MB of generated logs')
+    parser.add_option('--tests', dest='tests', action='store',
+                      default='5000', help='Number of tests of memory '
+                      'benchmark')
+    parser.add_option('--domains', dest='domains', action='store',
+                      default='50', help='Number of domains of memory '
+                      'benchmark')
+    parser.add_option('--log-size', dest='log_size', action='store',
+                      default='16', help='Size in KiB of test logs of '
+                      'memory benchmark')
+    parser.add_option('--pools', dest='pools', action='store', default='5',
+                      help='Number of storage pools')
+    parser.add_option('--volumes', dest='volumes', action='store',
+                      default='20', help='Number of volumes in each pool')
+    parser.add_option('--secrets', dest='secrets', action='store',
+                      default='10', help='Number of secrets')
+    parser.add_option('--mounts', dest='mounts', action='store',
+                      default='100', help='Number of mount points')
+    parser.add_option('--dir-entries', dest='dir_entries', action='store',
+                      default='10000', help='Number of files in checked '
+                      'directory')
+    parser.add_option('--bench', dest='bench', action='store',
+                      default='sanitize,harness,memory',
+                      help='Benchmarks to run, separated by ","')
+    parser.add_option('--save', dest='save', action='store', default='',
+                      help='Save results to a JSON file')
+    parser.add_option('--baseline', dest='baseline', action='store',
+                      default='', help='Compare results with a JSON file '
+                      'saved by --save, exit with 1 on regressions')
+    parser.add_option('--tolerance', dest='tolerance', action='store',
+                      default='1.5', help='Ratio to baseline reported as '
+                      'regression')
+    parser.add_option('--memory-mode', dest='memory_mode', action='store',
+                      default='', help=optparse.SUPPRESS_HELP)
+    args, _ = parser.parse_args()
+    for name in ('tests', 'domains', 'pools', 'volumes', 'secrets',
+                 'mounts', 'dir_entries'):
+        setattr(args, name, int(getattr(args, name)))
+    args.log_size = int(args.log_size) * 1024
+    if args.memory_mode:
+        memory_run(args.memory_mode, args.tests, args.domains, args.log_size)
+        return
+    results = {}
+    benches = args.bench.split(',')
+    if 'sanitize' in benches:
+        results.update(bench_sanitize(float(args.size)))
+    if 'harness' in benches:
+        results.update(bench_harness(args))
+    if 'memory' in benches:
+        results.update(bench_memory(args.tests, args.domains, args.log_size))
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+    if args.baseline:
+        if compare_baseline(results, args.baseline, float(args.tolerance)):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# vi:set ts=4 sw=4 expandtab:
@@ -9,11 +9,33 @@ import json
 import shutil
 import string
 import difflib
+import hashlib
+import stat
 import logging
 import optparse
 import tempfile
 import fileinput
 import traceback
+import threading
+import Queue
+import select
+import signal
+import errno
+import subprocess
+import socket
+import runpy
+import cProfile
+import ast
+import collections
+import zlib
+import base64
+import fcntl
+import httplib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import xml.etree.ElementTree as ElementTree
 from virttest import common
 from virttest import utils_libvirtd, utils_selinux
 from virttest import data_dir
@@ -24,6 +46,49 @@ from virttest.utils_misc import mount, umount
 from autotest.client.tools import JUnit_api as api
 from autotest.client.shared import error
 from datetime import date
+try:
+    import libvirt
+except ImportError:
+    libvirt = None
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+# Output of ./run that makes further waiting pointless
+FATAL_PATTERNS = [r'Kernel panic - not syncing',
+                  r'Out of memory: Kill(ed)? process']
+
+# Bytes removed from logs put into report
+NON_PRINTABLE = ''.join(chr(c) for c in range(256)
+                        if chr(c) not in string.printable)
+NON_PRINTABLE_RE = re.compile(u'[^%s]' % re.escape(string.printable))
+
+
+def sanitize_log(log):
+    """
+    Remove non-printable characters from a log.
+
+    Byte strings are filtered by str.translate() in a single pass, non
+    ASCII bytes are removed as well.
+    """
+    if isinstance(log, unicode):
+        return NON_PRINTABLE_RE.sub(u'', log)
+    return log.translate(None, NON_PRINTABLE)
+
+
+def escape_str(inStr):
+    """
+    Escape a string for HTML use.
+    """
+    s1 = (isinstance(inStr, basestring) and inStr or
+          '%s' % inStr)
+    s1 = s1.replace('&', '&amp;')
+    s1 = s1.replace('<', '&lt;')
+    s1 = s1.replace('>', '&gt;')
+    s1 = s1.replace('"', "&quot;")
+    return s1
 
 
 class Report():
@@ -96,11 +161,49 @@ class Report():
     class skipType(api.failureType):
         pass
 
+    class TestResult(object):
+
+        """
+        Compact record of a test result, with the log compressed.
+
+        Test cases are created from results only while exporting.
+        """
+        __slots__ = ('name', 'time', 'kind', 'type_', 'message', 'log')
+
+        def __init__(self, name, time, log, kind=None, type_=None,
+                     message=None):
+            self.name = name
+            self.time = time
+            self.log = zlib.compress(log, 1)
+            self.kind = kind
+            self.type_ = type_
+            self.message = message
+
+        def testcase(self):
+            tc = Report.testcaseType()
+            tc.name = self.name
+            tc.time = self.time
+            tc.system_out = zlib.decompress(self.log)
+            if self.kind == 'failure':
+                tc.failure = Report.failureType(message=self.message,
+                                                type_=self.type_)
+            elif self.kind == 'error':
+                tc.error = Report.errorType(message=self.message,
+                                            type_=self.type_)
+            elif self.kind == 'skip':
+                tc.skip = Report.skipType(message=self.message,
+                                          type_=self.type_)
+            return tc
+
     class testsuite(api.testsuite):
 
         def __init__(self, name=None, skips=None):
             api.testsuite.__init__(self, name=name)
             self.skips = api._cast(int, skips)
+            # Offsets of journaled testcases, exported from self.journal
+            self.journal = None
+            self.offsets = []
+            self.results = []
 
         def exportAttributes(
                 self, outfile, level, already_processed,
@@ -114,14 +217,36 @@ class Report():
                               self.gds_format_integer(self.skips,
                                                       input_name='skipped'))
 
-    def __init__(self, fail_diff=False):
+        def exportChildren(self, outfile, level, namespace_='',
+                           name_='testsuite', fromsubclass_=False):
+            api.testsuite.exportChildren(
+                self, outfile, level, namespace_, name_, fromsubclass_)
+            for result in self.results:
+                result.testcase().export(outfile, level, namespace_,
+                                         name_='testcase')
+            if self.journal is not None:
+                for offset in self.offsets:
+                    self.journal.seek(offset)
+                    entry = json.loads(self.journal.readline())
+                    outfile.write(entry['testcase'].encode('utf-8'))
+
+        def hasContent_(self):
+            if self.offsets or self.results:
+                return True
+            return api.testsuite.hasContent_(self)
+
+    def __init__(self, fail_diff=False, journal=None):
         self.ts_dict = {}
         self.fail_diff = fail_diff
+        self.journal = journal
 
     def save(self, filename):
         """
         Save current state of report to files.
         """
+        if self.journal:
+            self.save_journal(filename)
+            return
         testsuites = api.testsuites()
         for ts_name in self.ts_dict:
             ts = self.ts_dict[ts_name]
@@ -129,81 +254,695 @@ class Report():
         with open(filename, 'w') as fp:
             testsuites.export(fp, 0)
 
-    def update(self, testname, ts_name, result, log, error_msg, duration):
-        """
-        Insert a new item into report.
+    def load_journal(self):
         """
-        def escape_str(inStr):
-            """
-            Escape a string for HTML use.
-            """
-            s1 = (isinstance(inStr, basestring) and inStr or
-                  '%s' % inStr)
-            s1 = s1.replace('&', '&amp;')
-            s1 = s1.replace('<', '&lt;')
-            s1 = s1.replace('>', '&gt;')
-            s1 = s1.replace('"', "&quot;")
-            return s1
-
-        if ts_name not in self.ts_dict:
-            self.ts_dict[ts_name] = self.testsuite(name=ts_name)
-            ts = self.ts_dict[ts_name]
-            ts.failures = 0
-            ts.skips = 0
-            ts.tests = 0
-            ts.errors = 0
-        else:
-            ts = self.ts_dict[ts_name]
+        Rebuild test suites with counters from journal entries.
 
-        tc = self.testcaseType()
-        tc.name = testname
-        tc.time = duration
+        Only the offset of each testcase is kept, the exported testcases
+        are read back from the journal when the report is saved. A
+        truncated last entry left by a crash is ignored.
+        """
+        ts_dict = {}
+        if not os.path.exists(self.journal):
+            return ts_dict
+        with open(self.journal) as fp:
+            while True:
+                offset = fp.tell()
+                line = fp.readline()
+                if not line:
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    print 'Warning: Skipping broken journal entry at %s' % offset
+                    continue
+                ts_name = entry['suite']
+                if ts_name not in ts_dict:
+                    ts = self.testsuite(name=ts_name)
+                    ts.failures = 0
+                    ts.skips = 0
+                    ts.tests = 0
+                    ts.errors = 0
+                    ts_dict[ts_name] = ts
+                ts = ts_dict[ts_name]
+                if entry['counter']:
+                    setattr(ts, entry['counter'],
+                            getattr(ts, entry['counter']) + 1)
+                ts.tests += 1
+                ts.timestamp = entry['timestamp']
+                ts.offsets.append(offset)
+        return ts_dict
+
+    def save_journal(self, filename):
+        """
+        Materialize the journal into a xUnit report file.
+        """
+        ts_dict = self.load_journal()
+        testsuites = api.testsuites()
+        with open(self.journal) as journal:
+            for ts_name in ts_dict:
+                ts = ts_dict[ts_name]
+                ts.journal = journal
+                testsuites.add_testsuite(ts)
+            with open(filename, 'w') as fp:
+                testsuites.export(fp, 0)
+
+    def append_journal(self, ts_name, tc, counter):
+        """
+        Append an exported testcase to the journal.
+        """
+        buf = StringIO.StringIO()
+        tc.export(buf, 2, name_='testcase')
+        entry = {
+            'suite': ts_name,
+            'name': tc.name,
+            'counter': counter,
+            'timestamp': date.isoformat(date.today()),
+            'testcase': buf.getvalue(),
+        }
+        with open(self.journal, 'a') as fp:
+            fp.write(json.dumps(entry) + '\n')
+
+    def resume_journal(self, keep):
+        """
+        Drop journal entries of tests not to be kept and return the
+        (suite, name) pairs of the remaining ones.
 
-        # Filter non-printable characters in log
-        log = ''.join(s for s in unicode(log, errors='ignore')
-                      if s in string.printable)
-        tc.system_out = log
+        _keep_ is called with the suite and name of each entry. Broken
+        entries and duplicates of a test are dropped too.
+        """
+        done = set()
+        if not os.path.exists(self.journal):
+            return done
+        with open(self.journal) as fp:
+            lines = fp.readlines()
+        with open(self.journal, 'w') as fp:
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    print 'Warning: Skipping broken journal entry: %s' % line
+                    continue
+                key = (entry['suite'], entry.get('name'))
+                if key in done or not keep(*key):
+                    continue
+                done.add(key)
+                fp.write(line)
+        return done
 
+    def update(self, testname, ts_name, result, log, error_msg, duration):
+        """
+        Insert a new item into report.
+        """
         error_msg = [escape_str(l) for l in error_msg]
 
+        counter = None
+        kind = None
+        type_ = None
         if 'FAIL' in result:
             error_msg.insert(0, 'Test %s has failed' % testname)
-            tc.failure = self.failureType(
-                message='&#10;'.join(error_msg),
-                type_='Failure')
-            ts.failures += 1
+            kind, type_, counter = 'failure', 'Failure', 'failures'
         elif 'TIMEOUT' in result:
             error_msg.insert(0, 'Test %s has timed out' % testname)
-            tc.failure = self.failureType(
-                message='&#10;'.join(error_msg),
-                type_='Timeout')
-            ts.failures += 1
+            kind, type_, counter = 'failure', 'Timeout', 'failures'
         elif 'ERROR' in result or 'INVALID' in result:
             error_msg.insert(0, 'Test %s has encountered error' % testname)
-            tc.error = self.errorType(
-                message='&#10;'.join(error_msg),
-                type_='Error')
-            ts.errors += 1
+            kind, type_, counter = 'error', 'Error', 'errors'
         elif 'SKIP' in result:
             error_msg.insert(0, 'Test %s is skipped' % testname)
-            tc.skip = self.skipType(
-                message='&#10;'.join(error_msg),
-                type_='Skip')
-            ts.skips += 1
+            kind, type_, counter = 'skip', 'Skip', 'skips'
         elif 'DIFF' in result and self.fail_diff:
             error_msg.insert(0, 'Test %s results dirty environment' % testname)
-            tc.failure = self.failureType(
-                message='&#10;'.join(error_msg),
-                type_='DIFF')
-            ts.failures += 1
-        ts.add_testcase(tc)
+            kind, type_, counter = 'failure', 'DIFF', 'failures'
+        message = '&#10;'.join(error_msg) if kind else None
+        test_result = self.TestResult(testname, duration, sanitize_log(log),
+                                      kind, type_, message)
+
+        if self.journal:
+            self.append_journal(ts_name, test_result.testcase(), counter)
+            return
+
+        if ts_name not in self.ts_dict:
+            self.ts_dict[ts_name] = self.testsuite(name=ts_name)
+            ts = self.ts_dict[ts_name]
+            ts.failures = 0
+            ts.skips = 0
+            ts.tests = 0
+            ts.errors = 0
+        else:
+            ts = self.ts_dict[ts_name]
+        if counter:
+            setattr(ts, counter, getattr(ts, counter) + 1)
+        ts.results.append(test_result)
         ts.tests += 1
         ts.timestamp = date.isoformat(date.today())
 
 
+class LibvirtSnapshot():
+
+    """
+    Collect libvirt objects in bulk through one persistent connection.
+
+    The collected infos use the same keys and value formats as the virsh
+    based State.get_info(), so both can be compared and restored alike.
+    """
+    # VIR_DOMAIN_XML_INACTIVE, VIR_NETWORK_XML_INACTIVE and
+    # VIR_STORAGE_XML_INACTIVE
+    domain_xml_inactive = 2
+    network_xml_inactive = 1
+    pool_xml_inactive = 1
+    domain_states = {0: 'no state', 1: 'running', 2: 'idle', 3: 'paused',
+                     4: 'in shutdown', 5: 'shut off', 6: 'crashed',
+                     7: 'pmsuspended'}
+    pool_states = {0: 'inactive', 1: 'building', 2: 'running',
+                   3: 'degraded', 4: 'inaccessible'}
+    collectors = {'domain': 'get_domains', 'network': 'get_networks',
+                  'pool': 'get_pools', 'secret': 'get_secrets'}
+
+    def __init__(self, uri='', connect=None):
+        """
+        :param uri: Libvirt connection URI, default connection if empty.
+        :param connect: Function opening a connection from an URI,
+                        default to libvirt.open.
+        """
+        self.uri = uri or None
+        if connect is None:
+            connect = libvirt.open
+        self.connect = connect
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def connection(self):
+        """
+        Return the connection, reconnecting if libvirtd was restarted.
+        """
+        with self.lock:
+            if self.conn is not None:
+                try:
+                    if self.conn.isAlive():
+                        return self.conn
+                except Exception:
+                    pass
+                self.conn = None
+            self.conn = self.connect(self.uri)
+            return self.conn
+
+    def collect(self, kind):
+        """
+        Return infos of all objects of _kind_ keyed by name.
+        """
+        return getattr(self, self.collectors[kind])(self.connection())
+
+    def pretty_capacity(self, value):
+        """
+        Format a size in bytes like virsh pool-info does.
+        """
+        units = ['B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB', 'EiB']
+        value = float(value)
+        unit = 0
+        while value >= 1024 and unit < len(units) - 1:
+            value /= 1024
+            unit += 1
+        return '%.2f %s' % (value, units[unit])
+
+    def yes_no(self, value):
+        return 'yes' if value else 'no'
+
+    def get_domains(self, conn):
+        states = {}
+        model = conn.getSecurityModel()
+        for dom in conn.listAllDomains(0):
+            try:
+                info = dom.info()
+                active = dom.isActive()
+                infos = {
+                    'id': str(dom.ID()) if active else '-',
+                    'name': dom.name(),
+                    'uuid': dom.UUIDString(),
+                    'os type': dom.OSType(),
+                    'state': self.domain_states.get(info[0], 'no state'),
+                    'cpu(s)': str(info[3]),
+                    'max memory': '%d KiB' % info[1],
+                    'used memory': '%d KiB' % info[2],
+                    'persistent': self.yes_no(dom.isPersistent()),
+                    'autostart': ('enable' if dom.autostart()
+                                  else 'disable'),
+                    'managed save': self.yes_no(dom.hasManagedSaveImage(0)),
+                }
+                if active:
+                    infos['cpu time'] = '%.1fs' % (info[4] / 1e9)
+                if model and model[0]:
+                    infos['security model'] = model[0]
+                    infos['security doi'] = model[1]
+                    if active:
+                        label = dom.securityLabel()
+                        infos['security label'] = '%s (%s)' % (
+                            label[0],
+                            'enforcing' if label[1] else 'permissive')
+                infos['inactive xml'] = dom.XMLDesc(
+                    self.domain_xml_inactive).splitlines()
+            except Exception, e:
+                # The domain might be gone after listing
+                print 'Warning: Failed to collect domain: %s' % e
+                continue
+            states[infos['name']] = DomainItem(infos)
+        return states
+
+    def get_networks(self, conn):
+        states = {}
+        for net in conn.listAllNetworks(0):
+            try:
+                infos = {
+                    'name': net.name(),
+                    'uuid': net.UUIDString(),
+                    'active': self.yes_no(net.isActive()),
+                    'persistent': self.yes_no(net.isPersistent()),
+                    'autostart': self.yes_no(net.autostart()),
+                }
+                try:
+                    infos['bridge'] = net.bridgeName()
+                except Exception:
+                    pass
+                infos['inactive xml'] = net.XMLDesc(
+                    self.network_xml_inactive).splitlines()
+            except Exception, e:
+                print 'Warning: Failed to collect network: %s' % e
+                continue
+            states[infos['name']] = NetworkItem(infos)
+        return states
+
+    def get_pools(self, conn):
+        states = {}
+        for pool in conn.listAllStoragePools(0):
+            try:
+                info = pool.info()
+                infos = {
+                    'name': pool.name(),
+                    'uuid': pool.UUIDString(),
+                    'state': self.pool_states.get(info[0], 'unknown'),
+                    'persistent': self.yes_no(pool.isPersistent()),
+                    'autostart': self.yes_no(pool.autostart()),
+                }
+                if pool.isActive():
+                    infos['capacity'] = self.pretty_capacity(info[1])
+                    infos['allocation'] = self.pretty_capacity(info[2])
+                    infos['available'] = self.pretty_capacity(info[3])
+                    infos['volumes'] = ['%s %s' % (vol.name(), vol.path())
+                                        for vol in pool.listAllVolumes(0)]
+                else:
+                    infos['volumes'] = []
+                infos['inactive xml'] = pool.XMLDesc(
+                    self.pool_xml_inactive).splitlines()
+            except Exception, e:
+                print 'Warning: Failed to collect pool: %s' % e
+                continue
+            states[infos['name']] = PoolItem(infos)
+        return states
+
+    def get_secrets(self, conn):
+        states = {}
+        for secret in conn.listAllSecrets(0):
+            try:
+                uuid = secret.UUIDString()
+                states[uuid] = SecretItem(
+                    uuid=uuid, xml=secret.XMLDesc(0).splitlines())
+            except Exception, e:
+                print 'Warning: Failed to collect secret: %s' % e
+        return states
+
+
+class FakeLibvirtObject():
+
+    """
+    Stand-in of a libvirt domain, network, pool, volume or secret.
+
+    Every method returns the value of the same name in _props_.
+    """
+
+    def __init__(self, **props):
+        self.props = props
+
+    def __getattr__(self, name):
+        props = self.__dict__.get('props', {})
+        if name not in props:
+            raise AttributeError(name)
+        value = props[name]
+        return lambda *args: value
+
+
+class FakeLibvirtConnection():
+
+    """
+    Stand-in of a libvirt connection for testing LibvirtSnapshot.
+    """
+
+    def __init__(self, domains=(), networks=(), pools=(), secrets=(),
+                 security_model=('', '')):
+        self.domains = list(domains)
+        self.networks = list(networks)
+        self.pools = list(pools)
+        self.secrets = list(secrets)
+        self.security_model = list(security_model)
+
+    def isAlive(self):
+        return True
+
+    def getSecurityModel(self):
+        return self.security_model
+
+    def listAllDomains(self, flags=0):
+        return self.domains
+
+    def listAllNetworks(self, flags=0):
+        return self.networks
+
+    def listAllStoragePools(self, flags=0):
+        return self.pools
+
+    def listAllSecrets(self, flags=0):
+        return self.secrets
+
+
+class Tracer():
+
+    """
+    Record named spans of harness phases as Chrome trace events, which
+    chrome://tracing or Perfetto can open.
+
+    A disabled tracer records nothing, so spans are cheap to leave in
+    hot paths.
+    """
+
+    class Span():
+
+        def __init__(self, tracer, name, args):
+            self.tracer = tracer
+            self.name = name
+            self.args = args
+
+        def __enter__(self):
+            self.start = time.time()
+            return self
+
+        def __exit__(self, exc_type, exc_value, tb):
+            self.tracer.add(self.name, self.start, time.time() - self.start,
+                            self.args)
+            return False
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.origin = time.time()
+        self.pid = os.getpid()
+        self.events = []
+        # Names of threads seen, keyed by thread id
+        self.threads = {}
+
+    def span(self, name, **args):
+        """
+        Return a context manager recording a span named _name_, with
+        _args_ shown in the trace.
+        """
+        return Tracer.Span(self, name, args)
+
+    def add(self, name, start, duration, args=None):
+        """
+        Record a span that started at _start_ and took _duration_ seconds.
+        """
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        self.threads[thread.ident] = thread.name
+        event = {'name': name, 'ph': 'X', 'pid': self.pid,
+                 'tid': thread.ident,
+                 'ts': int((start - self.origin) * 1000000),
+                 'dur': int(duration * 1000000)}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def save(self, filename):
+        """
+        Save spans as a Chrome trace JSON file.
+        """
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                   'tid': tid, 'args': {'name': name}}
+                  for tid, name in self.threads.items()]
+        with open(filename, 'w') as fp:
+            json.dump({'traceEvents': events + self.events,
+                       'displayTimeUnit': 'ms'}, fp)
+
+    def summary(self):
+        """
+        Return lines of a table of durations by span name, longest total
+        first. Nested spans count in their parents too.
+        """
+        spans = {}
+        for event in self.events:
+            spans.setdefault(event['name'], []).append(event['dur'] / 1e6)
+        lines = ['%-40s %6s %10s %10s %10s' % (
+            'Span', 'Count', 'Total s', 'Mean s', 'Max s')]
+        for name, durations in sorted(spans.items(),
+                                      key=lambda item: -sum(item[1])):
+            lines.append('%-40s %6d %10.2f %10.3f %10.3f' % (
+                name[:40], len(durations), sum(durations),
+                sum(durations) / len(durations), max(durations)))
+        return lines
+
+
+class PathWatcher():
+
+    """
+    Record paths touched since last asked, using inotify.
+    """
+
+    def __init__(self):
+        self.dirty = set()
+        self.overflow = False
+        self.wm = None
+        self.notifier = None
+
+    def start(self, paths):
+        """
+        Start watching paths.
+
+        :param paths: A list of (path, recursive) tuples.
+        """
+        self.stop()
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.wm, self.process_event,
+                                           timeout=0)
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF)
+        for path, recursive in paths:
+            wds = self.wm.add_watch(path, mask, rec=recursive,
+                                    auto_add=recursive, quiet=True)
+            if [wd for wd in wds.values() if wd < 0]:
+                print 'Warning: Failed to watch %s' % path
+                self.overflow = True
+
+    def stop(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+
+    def process_event(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            self.overflow = True
+        else:
+            self.dirty.add(event.pathname)
+
+    def pop_dirty(self):
+        """
+        Return paths touched since last call.
+
+        :return: A set of paths, or None if some events might be lost.
+        """
+        while self.notifier.check_events(timeout=0):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        dirty, self.dirty = self.dirty, set()
+        overflow, self.overflow = self.overflow, False
+        if overflow:
+            return None
+        return dirty
+
+
+def slot_names(fields):
+    """
+    Return attribute names of state item keys, like 'cpu_s' for 'cpu(s)'.
+    """
+    return tuple(re.sub(r'[^a-z0-9]+', '_', key.lower()).strip('_')
+                 for key in fields)
+
+
+class StateItem(object):
+
+    """
+    Compact record of a state item, behaving like a dict of its infos.
+
+    Well known keys are kept in slots, other keys in an _extra_ dict.
+    Line lists are stored as tuples, so they can be shared between the
+    backup and current snapshots by share().
+    """
+    fields = ()
+    __slots__ = ('extra',)
+
+    def __init__(self, infos=None, **kwargs):
+        for slot in self.slot_map().values():
+            setattr(self, slot, None)
+        self.extra = None
+        for infos in (infos or {}, kwargs):
+            for key, value in infos.items():
+                self[key] = value
+
+    @classmethod
+    def slot_map(cls):
+        """
+        Return a dict mapping keys in slots to attribute names.
+        """
+        if '_slot_map' not in cls.__dict__:
+            cls._slot_map = dict(zip(cls.fields, slot_names(cls.fields)))
+        return cls._slot_map
+
+    def __setitem__(self, key, value):
+        if type(value) is list:
+            value = tuple(value)
+        slot = self.slot_map().get(key)
+        if slot is not None:
+            setattr(self, slot, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __getitem__(self, key):
+        slot = self.slot_map().get(key)
+        if slot is not None:
+            value = getattr(self, slot)
+            if value is not None:
+                return value
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        slot_map = self.slot_map()
+        for key in self.fields:
+            if getattr(self, slot_map[key]) is not None:
+                yield key
+        if self.extra is not None:
+            for key in self.extra:
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __eq__(self, other):
+        if not isinstance(other, StateItem):
+            return False
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
+    def keys(self):
+        return list(iter(self))
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def share(self, other):
+        """
+        Replace values equal to those of _other_ by the same objects.
+        """
+        for slot in self.slot_map().values():
+            value = getattr(self, slot)
+            other_value = getattr(other, slot)
+            if (value is not other_value and type(value) is tuple and
+                    value == other_value):
+                setattr(self, slot, other_value)
+
+
+class DomainItem(StateItem):
+    fields = ('id', 'name', 'uuid', 'os type', 'state', 'cpu(s)',
+              'cpu time', 'max memory', 'used memory', 'persistent',
+              'autostart', 'managed save', 'security model', 'security doi',
+              'security label', 'inactive xml')
+    __slots__ = slot_names(fields)
+
+
+class NetworkItem(StateItem):
+    fields = ('name', 'uuid', 'active', 'persistent', 'autostart', 'bridge',
+              'inactive xml')
+    __slots__ = slot_names(fields)
+
+
+class PoolItem(StateItem):
+    fields = ('name', 'uuid', 'state', 'persistent', 'autostart',
+              'capacity', 'allocation', 'available', 'volumes',
+              'inactive xml')
+    __slots__ = slot_names(fields)
+
+
+class SecretItem(StateItem):
+    fields = ('uuid', 'xml')
+    __slots__ = slot_names(fields)
+
+
+class MountItem(StateItem):
+    fields = ('mount_id', 'parent_id', 'src', 'mount_point', 'fstype',
+              'options')
+    __slots__ = slot_names(fields)
+
+
+class ServiceItem(StateItem):
+    fields = ('name', 'status')
+    __slots__ = slot_names(fields)
+
+
+class FileItem(StateItem):
+    fields = ('file-path', 'content')
+    __slots__ = slot_names(fields)
+
+
+class DirItem(StateItem):
+    # Entry names are kept in extra
+    fields = ('dir-name',)
+    __slots__ = slot_names(fields)
+
+
 class State():
     permit_keys = []
     permit_re = []
+    # Ordered states are checked one by one before the others
+    ordered = False
+    # LibvirtSnapshot collecting all objects of this state at once
+    snapshot = None
+    # Consecutive failures of the snapshot before giving it up
+    max_snapshot_failures = 3
+    snapshot_failures = 0
+    # PathWatcher telling which items might have changed
+    watcher = None
+    # Tracer recording collections and restores
+    tracer = Tracer()
 
     def get_names(self):
         raise NotImplementedError('Function get_names not implemented for %s.'
@@ -221,23 +960,219 @@ class State():
         raise NotImplementedError('Function restore not implemented for %s.'
                                   % self.__class__.__name__)
 
+    def repair(self, bak, cur):
+        """
+        Bring changed item _cur_ back to _bak_. Restore the whole item by
+        default, states may do less when only some keys changed.
+        """
+        self.restore(bak)
+
+    def sort_items(self, items, state, reverse=False):
+        """
+        Return items of _state_ in the order to restore them, or in the
+        order to remove them when _reverse_.
+        """
+        return list(items)
+
+    def dependencies(self, info):
+        """
+        Return resources an item provides and requires, as two sets of
+        (kind, value) tuples used by RestorePlanner to order restores
+        across states. A 'path' resource covers everything below it.
+        """
+        return set(), set()
+
+    def xml_root(self, lines):
+        """
+        Parse XML lines of an item, return None if unparsable.
+        """
+        try:
+            return ElementTree.fromstring('\n'.join(lines))
+        except Exception:
+            return None
+
+    def changed_keys(self, bak, cur):
+        """
+        Return keys whose values differ between two items, ignoring
+        permitted keys and permitted lines.
+        """
+        changed = set()
+        for key in set(bak) | set(cur):
+            if key in self.permit_keys:
+                continue
+            old, new = bak.get(key), cur.get(key)
+            if type(old) in (list, tuple) and type(new) in (list, tuple):
+                old = [line for line in old if not self.permit_re or
+                       not self.line_permitted(line)]
+                new = [line for line in new if not self.permit_re or
+                       not self.line_permitted(line)]
+            if old != new:
+                changed.add(key)
+        return changed
+
+    def apply(self, action, bak, cur, diff_msg):
+        """
+        Run a restore action on an item, reporting failures to _diff_msg_.
+
+        :param action: 'remove' to remove created item _cur_, 'restore' to
+                       restore deleted item _bak_ or 'repair' to bring
+                       changed item _cur_ back to _bak_.
+        """
+        item = bak if bak is not None else cur
+        try:
+            with self.tracer.span('%s.%s' % (self.name, action),
+                                  item=str(item.get('name', ''))):
+                if action == 'remove':
+                    self.remove(cur)
+                elif action == 'restore':
+                    self.restore(bak)
+                else:
+                    self.repair(bak, cur)
+        except Exception, e:
+            traceback.print_exc()
+            if action == 'remove':
+                diff_msg.append('Remove is failed:\n %s' % e)
+            else:
+                diff_msg.append('Recover is failed:\n %s' % e)
+
+    def recover(self, action, bak, cur, diff_msg, planner=None):
+        """
+        Apply a restore action now, or add it to _planner_ if given.
+        """
+        if planner is not None:
+            planner.add(self, action, bak, cur, diff_msg)
+        else:
+            self.apply(action, bak, cur, diff_msg)
+
     def get_state(self):
+        if (self.snapshot is not None and
+                self.name in self.snapshot.collectors):
+            try:
+                state = self.snapshot.collect(self.name)
+                self.snapshot_failures = 0
+                return state
+            except Exception, e:
+                # Both ways give the same values, so falling back for one
+                # collection keeps it comparable with the backup
+                print 'Warning: Falling back to virsh for %s: %s' % (
+                    self.name, e)
+                self.snapshot_failures += 1
+                if self.snapshot_failures >= self.max_snapshot_failures:
+                    print 'Warning: Giving up libvirt API for %s' % self.name
+                    self.snapshot = None
         names = self.get_names()
         state = {}
         for name in names:
             state[name] = self.get_info(name)
         return state
 
+    def line_permitted(self, line):
+        """
+        Check whether adding or removing a line is always permitted.
+        """
+        for sign in '-+':
+            for r in self.permit_re:
+                if re.match(r, sign + line):
+                    break
+            else:
+                return False
+        return True
+
+    def fingerprint(self, info):
+        """
+        Return a hash of an item, ignoring values of permitted keys and
+        permitted lines.
+
+        Items with same fingerprints never differ in check(), while items
+        with different fingerprints still need a full comparison.
+        """
+        sha = hashlib.sha1()
+        for key in sorted(info):
+            value = info[key]
+            sha.update('%r %s\0' % (key, type(value).__name__))
+            if type(value) is str:
+                if key not in self.permit_keys:
+                    sha.update(value)
+            elif type(value) in (list, tuple):
+                for line in value:
+                    if not self.permit_re or not self.line_permitted(line):
+                        sha.update(line + '\n')
+            else:
+                sha.update(repr(value))
+            sha.update('\0')
+        return sha.digest()
+
+    def watch_paths(self):
+        """
+        Return (path, recursive) tuples to watch for changes of items.
+        """
+        raise NotImplementedError('Function watch_paths not implemented '
+                                  'for %s.' % self.__class__.__name__)
+
+    def get_changed_state(self):
+        """
+        Get current state, collecting only items touched since last time
+        if the state is watched.
+        """
+        if self.watcher is None:
+            return self.get_state()
+        dirty = self.watcher.pop_dirty()
+        if dirty is None:
+            return self.get_state()
+        state = dict(self.last_state)
+        for name in self.get_names():
+            prefix = name.rstrip('/') + '/'
+            paths = [path for path in dirty
+                     if path == name or path.startswith(prefix)]
+            if name not in state:
+                state[name] = self.get_info(name)
+            elif paths:
+                state[name] = self.update_info(name, state[name], paths)
+        return state
+
+    def update_info(self, name, info, paths):
+        """
+        Return the info of an item given its last _info_ and the watched
+        _paths_ touched since then.
+        """
+        return self.get_info(name)
+
+    def share_state(self, state):
+        """
+        Replace items and values of _state_ equal to the backup ones by
+        the backup objects, so unchanged XML is kept only once.
+        """
+        for name, info in state.items():
+            bak = self.backup_state.get(name)
+            if bak is None or info is bak or not isinstance(info, StateItem):
+                continue
+            if info == bak:
+                state[name] = bak
+            elif type(info) is type(bak):
+                info.share(bak)
+        return state
+
     def backup(self):
         """
         Backup current state
         """
-        self.backup_state = self.get_state()
-
-    def check(self, recover=False):
+        if self.watcher is not None:
+            self.watcher.start(self.watch_paths())
+        with self.tracer.span('%s.get_state' % self.name):
+            self.backup_state = self.get_state()
+        self.last_state = self.backup_state
+        self.backup_fingerprints = dict(
+            (name, self.fingerprint(info))
+            for name, info in self.backup_state.items())
+
+    def check(self, recover=False, planner=None):
         """
         Check state changes and recover to specified state.
         Return a result.
+
+        :param planner: RestorePlanner to add restore actions to instead
+                        of running them, failures are added to the
+                        returned messages when the planner executes.
         """
         def diff_dict(dict_old, dict_new):
             created = set(dict_new) - set(dict_old)
@@ -264,35 +1199,36 @@ class State():
                     return False
             return True
 
-        self.current_state = self.get_state()
+        with self.tracer.span('%s.get_state' % self.name):
+            self.current_state = self.share_state(self.get_changed_state())
+        self.last_state = self.current_state
         diff_msg = []
         new_items, del_items, unchanged_items = diff_dict(
             self.backup_state, self.current_state)
         if new_items:
             diff_msg.append('Created %s(s):' % self.name)
-            for item in new_items:
+            for item in self.sort_items(new_items, self.current_state,
+                                        reverse=True):
                 diff_msg.append(item)
                 if recover:
-                    try:
-                        self.remove(self.current_state[item])
-                    except Exception, e:
-                        traceback.print_exc()
-                        diff_msg.append('Remove is failed:\n %s' % e)
+                    self.recover('remove', None, self.current_state[item],
+                                 diff_msg, planner)
 
         if del_items:
             diff_msg.append('Deleted %s(s):' % self.name)
-            for item in del_items:
+            for item in self.sort_items(del_items, self.backup_state):
                 diff_msg.append(item)
                 if recover:
-                    try:
-                        self.restore(self.backup_state[item])
-                    except Exception, e:
-                        traceback.print_exc()
-                        diff_msg.append('Recover is failed:\n %s' % e)
+                    self.recover('restore', self.backup_state[item], None,
+                                 diff_msg, planner)
 
-        for item in unchanged_items:
+        for item in self.sort_items(unchanged_items, self.backup_state):
             cur = self.current_state[item]
             bak = self.backup_state[item]
+            if cur is bak:
+                continue
+            if self.fingerprint(cur) == self.backup_fingerprints[item]:
+                continue
             item_changed = False
             new_keys, del_keys, unchanged_keys = diff_dict(bak, cur)
             if new_keys:
@@ -315,7 +1251,7 @@ class State():
                         item_changed = True
                         diff_msg.append('%s %s: %s changed: %s -> %s' % (
                             self.name, item, key, bak[key], cur[key]))
-                elif type(cur[key]) is list:
+                elif type(cur[key]) in (list, tuple):
                     diff = difflib.unified_diff(
                         bak[key], cur[key], lineterm="")
                     tmp_msg = []
@@ -331,11 +1267,7 @@ class State():
                     diff_msg.append('%s %s: %s: Invalid type %s.' % (
                         self.name, item, key, type(cur[key])))
             if item_changed and recover:
-                try:
-                    self.restore(self.backup_state[item])
-                except Exception, e:
-                    traceback.print_exc()
-                    diff_msg.append('Recover is failed:\n %s' % e)
+                self.recover('repair', bak, cur, diff_msg, planner)
         return diff_msg
 
 
@@ -389,8 +1321,58 @@ class DomainState(State):
             if res.exit_status:
                 raise Exception(str(res))
 
+    def repair(self, bak, cur):
+        """
+        Only start, stop, resume or toggle autostart when the definition
+        of a persistent domain is unchanged.
+        """
+        changed = self.changed_keys(bak, cur)
+        if (bak['persistent'] != 'yes' or
+                not changed <= set(['state', 'autostart'])):
+            return self.restore(bak)
+        name = bak['name']
+        if 'state' in changed:
+            if bak['state'] == 'shut off':
+                res = virsh.destroy(name)
+            elif bak['state'] == 'running' and cur['state'] == 'shut off':
+                res = virsh.start(name)
+            elif bak['state'] == 'running' and cur['state'] == 'paused':
+                res = virsh.resume(name)
+            else:
+                return self.restore(bak)
+            if res.exit_status:
+                raise Exception(str(res))
+        if 'autostart' in changed:
+            res = virsh.autostart(
+                name, '' if bak['autostart'] == 'enable' else '--disable')
+            if res.exit_status:
+                raise Exception(str(res))
+
+    def dependencies(self, info):
+        """
+        A domain requires networks, pools and secrets it refers to and
+        the paths of its disks.
+        """
+        requires = set()
+        root = self.xml_root(info['inactive xml'])
+        if root is None:
+            return set(), requires
+        for source in root.findall('devices/disk/source'):
+            if source.get('pool'):
+                requires.add(('pool', source.get('pool')))
+            for attr in ('file', 'dev', 'dir'):
+                if source.get(attr):
+                    requires.add(('path', source.get(attr)))
+        for source in root.findall('devices/interface/source'):
+            if source.get('network'):
+                requires.add(('network', source.get('network')))
+        for secret in root.iter('secret'):
+            if secret.get('uuid'):
+                requires.add(('secret', secret.get('uuid')))
+        return set(), requires
+
     def get_info(self, name):
-        infos = {}
+        infos = DomainItem()
         for line in virsh.dominfo(name).stdout.strip().splitlines():
             key, value = line.split(':', 1)
             infos[key.lower()] = value.strip()
@@ -462,8 +1444,34 @@ class NetworkState(State):
             if res.exit_status:
                 raise Exception(str(res))
 
+    def repair(self, bak, cur):
+        """
+        Only start, stop or toggle autostart when the definition of a
+        persistent network is unchanged.
+        """
+        changed = self.changed_keys(bak, cur)
+        if (bak['persistent'] != 'yes' or
+                not changed <= set(['active', 'autostart'])):
+            return self.restore(bak)
+        name = bak['name']
+        if 'active' in changed:
+            if bak['active'] == 'yes':
+                res = virsh.net_start(name)
+            else:
+                res = virsh.net_destroy(name)
+            if res.exit_status:
+                raise Exception(str(res))
+        if 'autostart' in changed:
+            res = virsh.net_autostart(
+                name, '' if bak['autostart'] == 'yes' else '--disable')
+            if res.exit_status:
+                raise Exception(str(res))
+
+    def dependencies(self, info):
+        return set([('network', info['name'])]), set()
+
     def get_info(self, name):
-        infos = {}
+        infos = NetworkItem()
         for line in virsh.net_info(name).stdout.strip().splitlines():
             key, value = line.split()
             if key.endswith(':'):
@@ -534,14 +1542,55 @@ class PoolState(State):
             if res.exit_status:
                 raise Exception(str(res))
 
+    def repair(self, bak, cur):
+        """
+        Only start, stop or toggle autostart when the definition and the
+        volumes of a persistent pool are unchanged.
+        """
+        changed = self.changed_keys(bak, cur)
+        if (bak['persistent'] != 'yes' or
+                not changed <= set(['state', 'autostart'])):
+            return self.restore(bak)
+        name = bak['name']
+        if 'state' in changed:
+            if bak['state'] == 'running':
+                res = virsh.pool_start(name)
+            else:
+                res = virsh.pool_destroy(name)
+            if res.exit_status:
+                raise Exception(str(res))
+        if 'autostart' in changed:
+            res = virsh.pool_autostart(
+                name, '' if bak['autostart'] == 'yes' else '--disable')
+            if res.exit_status:
+                raise Exception(str(res))
+
+    def dependencies(self, info):
+        """
+        A pool provides its target path, which requires the mount points
+        it is on, including one mounted right at the target.
+        """
+        provides = set([('pool', info['name'])])
+        requires = set()
+        root = self.xml_root(info['inactive xml'])
+        if root is not None:
+            path = root.findtext('target/path')
+            if path:
+                provides.add(('path', path))
+                requires.add(('path', path))
+        return provides, requires
+
     def get_info(self, name):
-        infos = {}
+        infos = PoolItem()
         for line in virsh.pool_info(name).stdout.strip().splitlines():
             key, value = line.split(':', 1)
             infos[key.lower()] = value.strip()
         infos['inactive xml'] = virsh.pool_dumpxml(
             name, '--inactive').splitlines()
-        infos['volumes'] = virsh.vol_list(name).stdout.strip().splitlines()[2:]
+        # Same "name path" format as LibvirtSnapshot.get_pools()
+        infos['volumes'] = [
+            ' '.join(line.split()) for line in
+            virsh.vol_list(name).stdout.strip().splitlines()[2:]]
         return infos
 
     def get_names(self):
@@ -561,16 +1610,15 @@ class SecretState(State):
             raise Exception(str(res))
 
     def restore(self, name):
-        uuid = name
+        secret = name
         cur = self.current_state
-        bak = self.backup_state
 
-        if uuid in cur:
-            self.remove(name)
+        if secret['uuid'] in cur:
+            self.remove(cur[secret['uuid']])
 
         secret_file = tempfile.NamedTemporaryFile(delete=False)
         fname = secret_file.name
-        secret_file.writelines(bak[name]['xml'])
+        secret_file.writelines(secret['xml'])
         secret_file.close()
 
         try:
@@ -582,8 +1630,11 @@ class SecretState(State):
         finally:
             os.remove(fname)
 
+    def dependencies(self, info):
+        return set([('secret', info['uuid'])]), set()
+
     def get_info(self, name):
-        infos = {}
+        infos = SecretItem()
         infos['uuid'] = name
         infos['xml'] = virsh.secret_dumpxml(name).stdout.splitlines()
         return infos
@@ -595,9 +1646,18 @@ class SecretState(State):
 
 class MountState(State):
     name = 'mount'
-    permit_keys = []
+    # IDs change whenever a mount point is remounted
+    permit_keys = ['mount_id', 'parent_id']
     permit_re = []
-    info = {}
+    mountinfo = '/proc/self/mountinfo'
+
+    def __init__(self, scope=None):
+        """
+        :param scope: Mount points to check with their sub-mounts, all
+                      mount points are checked if not given.
+        """
+        self.scope = [path.rstrip('/') or '/' for path in scope or []]
+        self.mounts = {}
 
     def remove(self, name):
         info = name
@@ -613,33 +1673,81 @@ class MountState(State):
                      info['options'], verbose=False):
             raise Exception("Failed to mount %s" % info['mount_point'])
 
+    def sort_items(self, items, state, reverse=False):
+        """
+        Sort mount points with parents before their children.
+        """
+        by_id = dict((info['mount_id'], info) for info in state.values())
+
+        def depth(name):
+            count = 0
+            info = state[name]
+            while info['parent_id'] in by_id and count < len(by_id):
+                info = by_id[info['parent_id']]
+                count += 1
+            return count
+
+        return sorted(items, key=lambda name: (depth(name), name),
+                      reverse=reverse)
+
+    def dependencies(self, info):
+        """
+        A mount point provides its path and requires its parent directory.
+        """
+        mount_point = info['mount_point']
+        requires = set()
+        if mount_point != '/':
+            requires.add(('path', os.path.dirname(mount_point.rstrip('/'))))
+        return set([('path', mount_point)]), requires
+
+    def in_scope(self, mount_point):
+        if not self.scope:
+            return True
+        for path in self.scope:
+            if (mount_point == path or path == '/' or
+                    mount_point.startswith(path + '/')):
+                return True
+        return False
+
     def get_info(self, name):
-        return self.info[name]
+        return self.mounts[name]
 
     def get_names(self):
         """
-        Get all mount infomations from /etc/mtab.
+        Get all mount informations from mountinfo at once.
 
-        :return: A dict using mount point as keys and 6-element dict as value.
+        :return: A list of mount points.
         """
-        lines = file('/etc/mtab').read().splitlines()
-        names = []
-        for line in lines:
-            values = line.split()
-            if len(values) != 6:
-                print 'Warning: Error parsing mountpoint: %s' % line
-                continue
-            keys = ['src', 'mount_point', 'fstype', 'options', 'dump', 'order']
-            mount_entry = dict(zip(keys, values))
-            mount_point = mount_entry['mount_point']
-            names.append(mount_point)
-            self.info[mount_point] = mount_entry
-        return names
+        mounts = {}
+        with open(self.mountinfo) as fp:
+            for line in fp:
+                values = line.split()
+                try:
+                    sep = values.index('-', 6)
+                    src, super_options = values[sep + 2], values[sep + 3]
+                except (ValueError, IndexError):
+                    print 'Warning: Error parsing mountpoint: %s' % line.strip()
+                    continue
+                mount_point = values[4]
+                if not self.in_scope(mount_point):
+                    continue
+                options = values[5].split(',')
+                for option in super_options.split(','):
+                    if option not in options:
+                        options.append(option)
+                # Later mounts overmount the earlier ones
+                mounts[mount_point] = MountItem(
+                    mount_id=values[0], parent_id=values[1], src=src,
+                    mount_point=mount_point, fstype=values[sep + 1],
+                    options=','.join(options))
+        self.mounts = mounts
+        return mounts.keys()
 
 
 class ServiceState(State):
     name = 'service'
     libvirtd = utils_libvirtd.Libvirtd()
+    ordered = True
     permit_keys = []
     permit_re = []
 
@@ -670,46 +1778,370 @@ class ServiceState(State):
                 status = 'stopped'
         if name == 'selinux':
             status = utils_selinux.get_status()
-        return {'name': name, 'status': status}
+        return ServiceItem(name=name, status=status)
 
     def get_names(self):
         return ['libvirtd', 'selinux']
 
 
 class DirState(State):
+
+    """
+    Entries of watched directories.
+
+    In recursive mode, files larger than the backup limit, like guest
+    images, can not be restored, so changes of their size and mtime are
+    permitted. Replacing or removing them is still reported.
+    """
     name = 'directory'
     permit_keys = ['aexpect']
     permit_re = []
 
+    def __init__(self, recursive=False, backup_dir=None,
+                 backup_limit=10 * 1024 * 1024):
+        """
+        :param recursive: Walk directory trees and record metadata of
+                          every entry instead of only top level names.
+        :param backup_dir: Directory of a content-addressed store used to
+                           restore deleted or modified files.
+        :param backup_limit: Files larger than this are never backed up.
+        """
+        self.recursive = recursive
+        self.backup_dir = backup_dir
+        self.backup_limit = backup_limit
+        # Directory path -> (directory stat key, sorted entry names)
+        self.scan_cache = {}
+        # File path -> (entry description, blob hash)
+        self.blobs = {}
+        if backup_dir:
+            self.load_blobs()
+
     def remove(self, name):
         raise Exception('It is not wise to remove a dir %s' % name)
 
+    def share_state(self, state):
+        """
+        Take backup descriptions of files over the backup limit whose
+        size or mtime only changed, then share items as usual.
+        """
+        if self.recursive:
+            for dirname, infos in state.items():
+                bak = self.backup_state.get(dirname)
+                if bak is None:
+                    continue
+                for fname, desc in infos.items():
+                    old = bak.get(fname)
+                    if (old is None or old == desc or
+                            not desc.startswith('file ') or
+                            not old.startswith('file ')):
+                        continue
+                    values, old_values = desc.split(' '), old.split(' ')
+                    if (values[3:] == old_values[3:] and
+                            max(int(values[1]), int(old_values[1])) >
+                            self.backup_limit):
+                        infos[fname] = old
+        return State.share_state(self, state)
+
     def restore(self, name):
         dirname = name['dir-name']
         cur = self.current_state[dirname]
         bak = self.backup_state[dirname]
         created_files = set(cur) - set(bak)
         if created_files:
-            for fname in created_files:
+            for fname in sorted(created_files, reverse=True):
                 fpath = os.path.join(name['dir-name'], fname)
-                if os.path.isfile(fpath):
-                    os.remove(fpath)
-                elif os.path.isdir(fpath):
+                if os.path.isdir(fpath) and not os.path.islink(fpath):
                     shutil.rmtree(fpath)
+                elif os.path.lexists(fpath):
+                    os.remove(fpath)
         deleted_files = set(bak) - set(cur)
-        if deleted_files:
-            for fname in deleted_files:
-                fpath = os.path.join(name['dir-name'], fname)
-                open(fpath, 'a').close()
-        # TODO: record file/dir info and recover them separately
+        if not self.recursive:
+            if deleted_files:
+                for fname in deleted_files:
+                    fpath = os.path.join(name['dir-name'], fname)
+                    open(fpath, 'a').close()
+            return
+
+        failed = []
+        changed_files = set(fname for fname in set(bak) & set(cur)
+                            if bak[fname] != cur[fname])
+        for fname in sorted(deleted_files | changed_files):
+            if fname == 'dir-name':
+                continue
+            fpath = os.path.join(dirname, fname)
+            if not self.restore_entry(fpath, bak[fname]):
+                failed.append(fpath)
+                continue
+            bak[fname] = self.describe(os.lstat(fpath))
+        self.backup_fingerprints[dirname] = self.fingerprint(bak)
+        if failed:
+            raise Exception('No backup to restore %s' % ', '.join(failed))
+
+    def restore_entry(self, fpath, desc):
+        """
+        Restore a file or directory to described metadata.
+
+        :return: False if the entry can not be restored.
+        """
+        values = desc.split(' ')
+        kind = values[0]
+        mode = int(values[-1], 8)
+        if kind == 'dir':
+            if not os.path.isdir(fpath):
+                if os.path.lexists(fpath):
+                    os.remove(fpath)
+                os.makedirs(fpath)
+            os.chmod(fpath, stat.S_IMODE(mode))
+            return True
+        if kind != 'file':
+            return False
+        blob = self.blobs.get(fpath)
+        if not blob or blob[0] != desc:
+            return False
+        if os.path.isdir(fpath) and not os.path.islink(fpath):
+            shutil.rmtree(fpath)
+        elif os.path.lexists(fpath):
+            os.remove(fpath)
+        shutil.copyfile(self.blob_path(blob[1]), fpath)
+        os.chmod(fpath, stat.S_IMODE(mode))
+        mtime = float(values[2])
+        os.utime(fpath, (mtime, mtime))
+        self.blobs[fpath] = (self.describe(os.lstat(fpath)), blob[1])
+        return True
+
+    def describe(self, st):
+        """
+        Describe an entry by its metadata.
+        """
+        if stat.S_ISDIR(st.st_mode):
+            return 'dir %o' % st.st_mode
+        if stat.S_ISREG(st.st_mode):
+            return 'file %d %.6f %d %o' % (st.st_size, st.st_mtime,
+                                           st.st_ino, st.st_mode)
+        return 'other %d %o' % (st.st_ino, st.st_mode)
+
+    def scan(self, top, rel, infos):
+        """
+        Record metadata of all entries under a directory into _infos_.
+
+        Entry names of a directory are listed again only when its
+        mtime changed, while entries are always stat'ed since modifying a
+        file does not change the mtime of its directory. File contents
+        are never read.
+        """
+        path = os.path.join(top, rel)
+        st = os.lstat(path)
+        key = (st.st_mtime, st.st_ctime, st.st_ino)
+        cached = self.scan_cache.get(path)
+        if cached and cached[0] == key:
+            entries = cached[1]
+        else:
+            entries = sorted(os.listdir(path))
+            self.scan_cache[path] = (key, entries)
+        for entry in entries:
+            entry_rel = os.path.join(rel, entry)
+            try:
+                entry_st = os.lstat(os.path.join(top, entry_rel))
+            except OSError:
+                continue
+            infos[entry_rel] = self.describe(entry_st)
+            if (stat.S_ISDIR(entry_st.st_mode) and
+                    entry_rel not in self.permit_keys):
+                self.scan(top, entry_rel, infos)
+
+    def blob_path(self, digest):
+        return os.path.join(self.backup_dir, digest[:2], digest[2:])
+
+    def load_blobs(self):
+        index = os.path.join(self.backup_dir, 'index.json')
+        if os.path.exists(index):
+            try:
+                with open(index) as fp:
+                    self.blobs = dict((k, tuple(v))
+                                      for k, v in json.load(fp).items())
+            except ValueError:
+                self.blobs = {}
+
+    def save_blobs(self):
+        index = os.path.join(self.backup_dir, 'index.json')
+        with open(index + '.tmp', 'w') as fp:
+            json.dump(self.blobs, fp)
+        os.rename(index + '.tmp', index)
+
+    def store_blob(self, fpath):
+        """
+        Copy a file into the content-addressed store.
+
+        :return: The SHA-1 hex digest of the file.
+        """
+        sha = hashlib.sha1()
+        tmp = tempfile.NamedTemporaryFile(dir=self.backup_dir, delete=False)
+        try:
+            with open(fpath, 'rb') as fp:
+                while True:
+                    chunk = fp.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    tmp.write(chunk)
+            tmp.close()
+            digest = sha.hexdigest()
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                os.remove(tmp.name)
+            else:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                os.rename(tmp.name, path)
+        except:
+            tmp.close()
+            if os.path.exists(tmp.name):
+                os.remove(tmp.name)
+            raise
+        return digest
+
+    def backup(self):
+        """
+        Backup current state, and small files with changed metadata.
+        """
+        State.backup(self)
+        if not self.recursive or not self.backup_dir:
+            return
+        if not os.path.isdir(self.backup_dir):
+            os.makedirs(self.backup_dir)
+        for dirname, infos in self.backup_state.items():
+            for fname, desc in infos.items():
+                if fname == 'dir-name' or not desc.startswith('file '):
+                    continue
+                if int(desc.split(' ')[1]) > self.backup_limit:
+                    continue
+                fpath = os.path.join(dirname, fname)
+                blob = self.blobs.get(fpath)
+                if blob and blob[0] == desc:
+                    continue
+                try:
+                    self.blobs[fpath] = (desc, self.store_blob(fpath))
+                except (IOError, OSError), e:
+                    print 'Warning: Failed to backup %s: %s' % (fpath, e)
+        self.save_blobs()
 
     def get_info(self, name):
-        infos = {}
+        infos = DirItem()
         infos['dir-name'] = name
+        if self.recursive:
+            self.scan(name, '', infos)
+            return infos
         for f in os.listdir(name):
             infos[f] = f
         return infos
 
+    def update_info(self, name, infos, paths):
+        """
+        Update entries of a directory tree touched since last time.
+
+        Only touched entries are stat'ed again, and only touched
+        directories and parents of touched entries are listed again. New
+        directories are scanned as a whole, since entries created before
+        they are watched cause no events. The last item is updated in
+        place unless it is the backup one.
+        """
+        if not self.recursive or name in paths:
+            return self.get_info(name)
+        if infos is self.backup_state.get(name):
+            copied = DirItem()
+            copied['dir-name'] = name
+            copied.extra = dict(infos.extra or {})
+            infos = copied
+        if infos.extra is None:
+            infos.extra = {}
+        entries = infos.extra
+
+        def permitted(rel):
+            parts = rel.split('/')
+            return [idx for idx in range(1, len(parts))
+                    if '/'.join(parts[:idx]) in self.permit_keys]
+
+        def under(rel, dirs):
+            return [d for d in dirs if rel == d or rel.startswith(d + '/')]
+
+        to_stat = set(os.path.relpath(path, name) for path in paths)
+        to_stat = set(rel for rel in to_stat if not permitted(rel))
+        to_list = set(os.path.dirname(rel) for rel in to_stat)
+        listed = set()
+        scanned = set()
+        while to_list or to_stat:
+            gone = set()
+            for parent in sorted(to_list - listed):
+                listed.add(parent)
+                path = os.path.join(name, parent)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISDIR(st.st_mode) or under(parent, scanned):
+                    continue
+                cached = self.scan_cache.get(path)
+                if cached is None:
+                    if parent and under(parent, to_stat):
+                        # A new directory, scanned below
+                        continue
+                    return self.get_info(name)
+                entries_now = sorted(os.listdir(path))
+                self.scan_cache[path] = (
+                    (st.st_mtime, st.st_ctime, st.st_ino), entries_now)
+                gone |= set(os.path.join(parent, entry)
+                            for entry in set(cached[1]) - set(entries_now))
+                to_stat |= set(os.path.join(parent, entry)
+                               for entry in set(entries_now) - set(cached[1]))
+            to_list = set()
+
+            for rel in sorted(to_stat, key=lambda rel: rel.count('/')):
+                if under(rel, scanned):
+                    continue
+                try:
+                    st = os.lstat(os.path.join(name, rel))
+                except OSError:
+                    gone.add(rel)
+                    continue
+                old = entries.get(rel)
+                entries[rel] = self.describe(st)
+                if old is not None and old.startswith('dir '):
+                    cached = self.scan_cache.get(os.path.join(name, rel))
+                    if (not stat.S_ISDIR(st.st_mode) or
+                            (cached and cached[0][2] != st.st_ino)):
+                        # Replaced by a file or another directory
+                        self.remove_subtree(name, entries, rel)
+                        old = None
+                    elif rel not in self.permit_keys:
+                        to_list.add(rel)
+                if (stat.S_ISDIR(st.st_mode) and old is None and
+                        rel not in self.permit_keys):
+                    self.scan(name, rel, infos)
+                    scanned.add(rel)
+            to_stat = set()
+
+            for rel in gone:
+                old = entries.pop(rel, None)
+                if old is not None and old.startswith('dir '):
+                    self.remove_subtree(name, entries, rel)
+        return infos
+
+    def remove_subtree(self, name, entries, rel):
+        """
+        Remove entries and cached listings under directory _rel_ of the
+        tree _name_.
+        """
+        prefix = rel + '/'
+        for key in [key for key in entries if key.startswith(prefix)]:
+            del entries[key]
+        path = os.path.join(name, rel)
+        for key in [key for key in self.scan_cache
+                    if key == path or key.startswith(path + '/')]:
+            del self.scan_cache[key]
+
+    def watch_paths(self):
+        return [(name, self.recursive) for name in self.get_names()]
+
     def get_names(self):
         return ['/tmp',
                 data_dir.get_tmp_dir(),
@@ -734,20 +2166,1566 @@ class FileState(State):
             with open(file_path, 'w') as f:
                 f.write(bak['content'])
 
+    def watch_paths(self):
+        return [(os.path.dirname(name), False) for name in self.get_names()]
+
     def get_info(self, name):
-        infos = {}
+        infos = FileItem()
         infos['file-path'] = name
         with open(name) as f:
             infos['content'] = f.read()
         return infos
 
-    def get_names(self):
-        return ['/etc/exports',
-                '/etc/libvirt/libvirtd.conf',
-                '/etc/libvirt/qemu.conf']
+    def get_names(self):
+        return ['/etc/exports',
+                '/etc/libvirt/libvirtd.conf',
+                '/etc/libvirt/qemu.conf']
+
+
+class RestorePlanner():
+
+    """
+    Restore actions collected from State.check() of several states,
+    executed in dependency order.
+
+    Resources items provide and require, like a mount point, a pool or a
+    network, order actions into levels: created items are removed before
+    what they require, deleted and changed items are restored after it.
+    Actions of the same level run concurrently.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        # (state, action, bak, cur, diff_msg) tuples
+        self.actions = []
+
+    def add(self, state, action, bak, cur, diff_msg):
+        self.actions.append((state, action, bak, cur, diff_msg))
+
+    def satisfies(self, provided, required):
+        kind, value = provided
+        req_kind, req_value = required
+        if kind != req_kind:
+            return False
+        if kind == 'path':
+            return (req_value == value or
+                    req_value.startswith(value.rstrip('/') + '/'))
+        return req_value == value
+
+    def levels(self, actions):
+        """
+        Split actions into levels, where actions only require resources
+        provided by actions of earlier levels. Actions in a dependency
+        cycle form a last level.
+        """
+        deps = []
+        for state, action, bak, cur, _ in actions:
+            deps.append(state.dependencies(cur if action == 'remove'
+                                           else bak))
+        requires = {}
+        for idx, (_, required) in enumerate(deps):
+            requires[idx] = set(
+                other for other, (provided, _) in enumerate(deps)
+                if other != idx and any(self.satisfies(pro, res)
+                                        for res in required
+                                        for pro in provided))
+        levels = []
+        done = set()
+        while len(done) < len(actions):
+            level = [idx for idx in range(len(actions))
+                     if idx not in done and requires[idx] <= done]
+            if not level:
+                level = [idx for idx in range(len(actions))
+                         if idx not in done]
+                # Break the cycle by running them one by one
+                levels += [[actions[idx]] for idx in level]
+                break
+            levels.append([actions[idx] for idx in level])
+            done.update(level)
+        return levels
+
+    def run_level(self, level):
+        """
+        Run actions of a level concurrently.
+        """
+        action_queue = Queue.Queue()
+        for action in level:
+            action_queue.put(action)
+
+        def worker():
+            while True:
+                try:
+                    state, action, bak, cur, diff_msg = \
+                        action_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                state.apply(action, bak, cur, diff_msg)
+
+        if len(level) == 1:
+            worker()
+            return
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.workers, len(level)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def execute(self):
+        """
+        Run all collected actions, removals first.
+        """
+        actions, self.actions = self.actions, []
+        removals = [action for action in actions if action[1] == 'remove']
+        restores = [action for action in actions if action[1] != 'remove']
+        for level in reversed(self.levels(removals)):
+            self.run_level(level)
+        for level in self.levels(restores):
+            self.run_level(level)
+
+
+class TestHistory():
+
+    """
+    Persistent record of measured durations and statuses of tests.
+    """
+    max_records = 10
+    default_duration = 60.0
+    # Passed runs needed before deriving a timeout from history
+    min_samples = 5
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tests = {}
+        self.load()
+
+    def load(self):
+        """
+        Load history from file, if any.
+        """
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as fp:
+                self.tests = json.load(fp)
+        except ValueError, e:
+            print 'Warning: Ignoring broken history %s: %s' % (
+                self.filename, e)
+            self.tests = {}
+
+    def save(self):
+        """
+        Save history to file.
+        """
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_name = self.filename + '.tmp'
+        with open(tmp_name, 'w') as fp:
+            json.dump(self.tests, fp)
+        os.rename(tmp_name, self.filename)
+
+    def record(self, test, status, duration):
+        """
+        Record a result of a test, keeping only the latest records.
+        """
+        entry = self.tests.setdefault(test, {'durations': []})
+        entry['status'] = status
+        entry['durations'].append(round(duration, 2))
+        del entry['durations'][:-self.max_records]
+        if status.split()[:1] == ['PASS']:
+            passed = entry.setdefault('passed', [])
+            passed.append(round(duration, 2))
+            del passed[:-self.max_records]
+
+    def record_reset(self, test, method, duration):
+        """
+        Record how long resetting the environment after a test took with
+        _method_, 'revert' or 'repair'.
+        """
+        entry = self.tests.setdefault(test, {'durations': []})
+        durations = entry.setdefault('resets', {}).setdefault(method, [])
+        durations.append(round(duration, 2))
+        del durations[:-self.max_records]
+
+    def cheaper_reset(self, test):
+        """
+        Return 'revert' or 'repair', whichever reset the environment
+        after a test faster on average. A method never recorded is tried
+        first.
+        """
+        resets = self.tests.get(test, {}).get('resets', {})
+        for method in ('revert', 'repair'):
+            if not resets.get(method):
+                return method
+        return min(('revert', 'repair'),
+                   key=lambda m: sum(resets[m]) / len(resets[m]))
+
+    def expected(self, test):
+        """
+        Return expected duration of a test.
+
+        Tests never run are expected to take the median time of known
+        tests.
+        """
+        if test in self.tests and self.tests[test]['durations']:
+            durations = self.tests[test]['durations']
+            return sum(durations) / len(durations)
+        if not hasattr(self, '_median'):
+            means = sorted(sum(e['durations']) / len(e['durations'])
+                           for e in self.tests.values() if e['durations'])
+            if means:
+                self._median = means[len(means) / 2]
+            else:
+                self._median = self.default_duration
+        return self._median
+
+    def percentile(self, test, pct):
+        """
+        Return the _pct_ percentile of recorded durations of passed runs
+        of a test, or None when there are less than _min_samples_ of them.
+        Skipped, failed and aborted runs may end early, so they never
+        count.
+        """
+        if test not in self.tests:
+            return None
+        durations = sorted(self.tests[test].get('passed', []))
+        if len(durations) < self.min_samples:
+            return None
+        return durations[min(len(durations) - 1,
+                             int(len(durations) * pct / 100.0))]
+
+    def longest_first(self, tests):
+        """
+        Sort tests by expected duration, longest first.
+        """
+        return sorted(tests, key=lambda t: (-self.expected(t), t))
+
+    def shard(self, tests, index, count):
+        """
+        Split tests into _count_ shards of balanced expected duration and
+        return the _index_th (0 based) of them, keeping the original order.
+
+        Tests are assigned longest first to the least loaded shard, so every
+        host given the same history produces the same shards. Histories of
+        hosts only agree when they share one file, an empty history splits
+        tests by name.
+        """
+        loads = [0.0] * count
+        assigned = set()
+        for test in self.longest_first(tests):
+            shard = loads.index(min(loads))
+            loads[shard] += self.expected(test)
+            if shard == index:
+                assigned.add(test)
+        return [t for t in tests if t in assigned]
+
+
+class OutputMonitor():
+
+    """
+    Scan output lines of ./run as they come, tee them to a log file and
+    keep only bounded tails in memory.
+
+    When stderr is merged into stdout, all lines are kept in one tail,
+    like output of a command redirecting 2>&1, and error log lines are
+    recognized by their prefix.
+    """
+    tail_lines = 1000
+    max_errors = 200
+    error_re = re.compile(r'^[0-9:]{8} ERROR\|')
+
+    def __init__(self, log_path=None, fatal_patterns=(), merged=False,
+                 tee=True):
+        """
+        :param merged: Whether stderr is merged into stdout.
+        :param tee: Whether to write lines to _log_path_, which is
+                    written by the command itself otherwise.
+        """
+        self.log_path = log_path
+        self.fatal_res = [re.compile(p) for p in fatal_patterns]
+        self.merged = merged
+        # First line matching a fatal pattern
+        self.fatal = None
+        self.log = None
+        if log_path and tee:
+            if not os.path.isdir(os.path.dirname(log_path)):
+                os.makedirs(os.path.dirname(log_path))
+            self.log = open(log_path, 'w')
+        self.stdout_tail = collections.deque(maxlen=self.tail_lines)
+        self.stderr_tail = collections.deque(maxlen=self.tail_lines)
+        self.errors = []
+        # (index, total, test name, status, duration) of status lines
+        self.statuses = []
+
+    def feed(self, line, stderr=False):
+        """
+        Scan a line of output without the line break.
+        """
+        if self.log is not None:
+            self.log.write(line + '\n')
+        if self.fatal is None:
+            for fatal_re in self.fatal_res:
+                if fatal_re.search(line):
+                    self.fatal = line
+                    break
+        if self.merged:
+            if (self.error_re.match(line) and
+                    len(self.errors) < self.max_errors):
+                self.errors.append(line)
+        elif stderr:
+            self.stderr_tail.append(line)
+            if 'ERROR' in line and len(self.errors) < self.max_errors:
+                self.errors.append(line)
+            return
+        self.stdout_tail.append(line)
+        match = re.match(r'^\(([0-9]+)/([0-9]+)\)\s', line)
+        if match:
+            fields = line.split()
+            if len(fields) < 3:
+                return
+            duration = re.search(r'\(([0-9.]+) s\)', line)
+            self.statuses.append((int(match.group(1)), int(match.group(2)),
+                                  fields[1].rstrip(':'), fields[2],
+                                  duration and float(duration.group(1))))
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+class BatchMonitor(OutputMonitor):
+
+    """
+    Monitor output of a ./run invocation running several tests, teeing
+    the output of each test to its own log file.
+
+    ./run orders tests by the Cartesian config, so output lines up to an
+    (i/n) status line go to a pending log, which is given to the test
+    named by the status line. The monitor of every test is kept in
+    _monitors_, None for tests never matched by a status line.
+
+    Stderr must be merged into stdout to keep the order of lines.
+    """
+
+    def __init__(self, tests, log_paths, fatal_patterns=()):
+        OutputMonitor.__init__(self, None, fatal_patterns, merged=True)
+        self.tests = tests
+        self.log_paths = log_paths
+        self.monitors = [None] * len(tests)
+        self.pending_path = os.path.join(os.path.dirname(log_paths[0]),
+                                         'batch-pending.log')
+        self.pending = OutputMonitor(self.pending_path, merged=True)
+
+    def match(self, name):
+        """
+        Return index of the test named _name_ in a status line, or None.
+        """
+        for index, test in enumerate(self.tests):
+            if (name == test or test.endswith('.' + name) or
+                    name.endswith('.' + test)):
+                return index
+        return None
+
+    def feed(self, line, stderr=False):
+        count = len(self.statuses)
+        OutputMonitor.feed(self, line, stderr)
+        self.pending.feed(line, stderr)
+        if len(self.statuses) == count:
+            return
+        _, total, name, _, _ = self.statuses[-1]
+        index = self.match(name)
+        self.pending.close()
+        if (total == len(self.tests) and index is not None and
+                self.monitors[index] is None):
+            os.rename(self.pending_path, self.log_paths[index])
+            self.pending.log_path = self.log_paths[index]
+            self.monitors[index] = self.pending
+        self.pending = OutputMonitor(self.pending_path, merged=True)
+
+    def close(self):
+        OutputMonitor.close(self)
+        self.pending.close()
+        if os.path.exists(self.pending_path):
+            os.remove(self.pending_path)
+
+
+class StreamResult():
+
+    """
+    Result of a command run by LibvirtCI.run_streaming().
+
+    Like autotest CmdResult, but stdout and stderr are only the tails
+    kept by the monitor. Full output is in the log file.
+
+    For merged output, both hold the whole tail, as stderr is the log
+    reported for a test.
+    """
+
+    def __init__(self, command, monitor, exit_status, duration,
+                 abort_reason=None):
+        self.command = command
+        self.stdout = '\n'.join(monitor.stdout_tail)
+        if monitor.merged:
+            self.stderr = self.stdout
+        else:
+            self.stderr = '\n'.join(monitor.stderr_tail)
+        self.merged = monitor.merged
+        self.errors = monitor.errors
+        self.log_path = monitor.log_path
+        self.exit_status = exit_status
+        self.duration = duration
+        # 'timeout', 'idle' or 'fatal' if the command was killed
+        self.abort_reason = abort_reason
+
+    def __str__(self):
+        return ('Command: %s\nExit status: %s\nDuration: %.2f\n'
+                'Log: %s\nStdout tail:\n%s\nStderr tail:\n%s' % (
+                    self.command, self.exit_status, self.duration,
+                    self.log_path, self.stdout, self.stderr))
+
+
+class GitHubClient():
+
+    """
+    Fetch pull request metadata and patches from GitHub.
+
+    Responses are cached on disk. A cached response younger than _ttl_
+    seconds is used directly, an older one is revalidated by its ETag.
+    Each thread reuses its own keep-alive connections, and fetch_all()
+    fetches several items concurrently.
+    """
+    oauth = ('?client_id=b6578298435c3eaa1e3d&client_secret'
+             '=59a1c828c6002ed4e8a9205486cf3fa86467a609')
+    max_redirects = 5
+
+    def __init__(self, cache_dir, api_url='https://api.github.com',
+                 web_url='https://github.com', ttl=300, workers=8):
+        self.cache_dir = cache_dir
+        self.api_url = api_url.rstrip('/')
+        self.web_url = web_url.rstrip('/')
+        self.ttl = ttl
+        self.workers = workers
+        self.local = threading.local()
+
+    def connection(self, scheme, netloc, fresh=False):
+        """
+        Return a connection of current thread to a host.
+        """
+        if not hasattr(self.local, 'conns'):
+            self.local.conns = {}
+        key = (scheme, netloc)
+        if fresh and key in self.local.conns:
+            self.local.conns.pop(key).close()
+        if key not in self.local.conns:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=60)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=60)
+            self.local.conns[key] = conn
+        return self.local.conns[key]
+
+    def request(self, url, headers):
+        """
+        Send a GET request following redirects.
+
+        :return: A tuple of status, ETag header and body.
+        """
+        for _ in range(self.max_redirects):
+            parsed = urlparse.urlsplit(url)
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+            for retry in (False, True):
+                conn = self.connection(parsed.scheme, parsed.netloc,
+                                       fresh=retry)
+                try:
+                    conn.request('GET', path, headers=headers)
+                    resp = conn.getresponse()
+                    body = resp.read()
+                    break
+                except (httplib.HTTPException, IOError):
+                    # Server closed a kept-alive connection
+                    if retry:
+                        raise
+            if resp.status in (301, 302, 303, 307, 308):
+                url = urlparse.urljoin(url, resp.getheader('location'))
+                continue
+            return resp.status, resp.getheader('etag'), body
+        raise Exception('Too many redirects fetching %s' % url)
+
+    def get(self, url):
+        """
+        Return body of an URL, using the cache when possible.
+
+        Bodies are cached as base64 of the raw bytes, since patches are not
+        always valid UTF-8.
+        """
+        cache_file = os.path.join(self.cache_dir,
+                                  hashlib.sha1(url).hexdigest() + '.json')
+        cached = None
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file) as fp:
+                    cached = json.load(fp)
+            except ValueError:
+                cached = None
+        if cached and 'body64' not in cached:
+            # Written by an older version with lossy decoding
+            cached = None
+        if cached and time.time() - cached['time'] < self.ttl:
+            return base64.b64decode(cached['body64'])
+
+        headers = {'User-Agent': 'virt-test-ci'}
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        status, etag, body = self.request(url, headers)
+        if status == 304 and cached:
+            cached['time'] = time.time()
+            body = base64.b64decode(cached['body64'])
+        elif status == 200:
+            cached = {'etag': etag, 'time': time.time(),
+                      'body64': base64.b64encode(body)}
+        else:
+            raise Exception('Failed fetching %s: HTTP %s' % (url, status))
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_file = '%s.%s.tmp' % (cache_file, threading.current_thread().ident)
+        with open(tmp_file, 'w') as fp:
+            json.dump(cached, fp)
+        os.rename(tmp_file, cache_file)
+        return body
+
+    def issue(self, repo_name, pr_number):
+        return json.loads(self.get('%s/repos/autotest/%s/issues/%s%s' % (
+            self.api_url, repo_name, pr_number, self.oauth)))
+
+    def comments(self, repo_name, pr_number):
+        return json.loads(self.get(
+            '%s/repos/autotest/%s/issues/%s/comments%s' % (
+                self.api_url, repo_name, pr_number, self.oauth)))
+
+    def patch(self, repo_name, pr_number):
+        return self.get('%s/autotest/%s/pull/%s.patch' % (
+            self.web_url, repo_name, pr_number))
+
+    def pr_open(self, repo_name, pr_number):
+        return self.issue(repo_name, pr_number)['state'] == 'open'
+
+    def fetch_all(self, func, items):
+        """
+        Return [func(item) for item in items], calling _func_ concurrently.
+        """
+        items = list(items)
+        results = [None] * len(items)
+        errors = []
+        item_queue = Queue.Queue()
+        for idx in range(len(items)):
+            item_queue.put(idx)
+
+        def worker():
+            while True:
+                try:
+                    idx = item_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[idx] = func(items[idx])
+                except Exception, e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.workers, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+
+class GitHubFixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    Serve GitHub API responses and patches from a fixture directory, for
+    testing GitHubClient offline.
+
+    Request path /repos/autotest/tp-libvirt/issues/1 is served from file
+    repos/autotest/tp-libvirt/issues/1.json and /autotest/tp-libvirt/pull/
+    1.patch from autotest/tp-libvirt/pull/1.patch. Query strings are
+    ignored. Example:
+
+        python -c 'import ci; ci.github_fixture_server("fixtures").serve_forever()'
+        ./ci.py --github-api http://localhost:8080 \\
+                --github-url http://localhost:8080 --pull-libvirt 1
+    """
+    protocol_version = 'HTTP/1.1'
+    fixture_dir = '.'
+
+    def do_GET(self):
+        path = urlparse.urlsplit(self.path).path.strip('/')
+        if not path.endswith('.patch'):
+            path += '.json'
+        path = os.path.join(self.fixture_dir, os.path.normpath(path))
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        with open(path) as fp:
+            body = fp.read()
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def github_fixture_server(fixture_dir, port=8080):
+    """
+    Return a HTTP server serving GitHub fixtures from _fixture_dir_.
+    """
+    class Handler(GitHubFixtureHandler):
+        pass
+    Handler.fixture_dir = os.path.abspath(fixture_dir)
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+    return Server(('localhost', port), Handler)
+
+
+class WorktreeCache():
+
+    """
+    Cached git worktrees with pull requests merged.
+
+    A worktree is keyed by the base commits and the sorted pull requests
+    of every repo, so the same combination is reused across runs and
+    different combinations can be tested at the same time. The first
+    layer is the virt-test worktree, following layers are nested in it.
+    A layer without pull requests is linked to the original checkout.
+
+    A run holds a shared lock on its worktree until release(), which
+    prevents prune() from removing worktrees in use.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.lock_files = {}
+
+    def key(self, layers):
+        """
+        Return the key of a worktree.
+
+        :param layers: List of (name, repo_dir, rel_dir, base, pull_nos).
+        """
+        sha = hashlib.sha1()
+        for name, _, rel_dir, base, pull_nos in layers:
+            sha.update('%s\0%s\0%s\0%s\0' % (
+                name, rel_dir, base, ','.join(sorted(pull_nos, key=int))))
+        return sha.hexdigest()[:16]
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lock(self, key, mode):
+        if key not in self.lock_files:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self.lock_files[key] = open(self.path(key) + '.lock', 'a')
+        fcntl.flock(self.lock_files[key], mode)
+
+    def release(self):
+        for lock_file in self.lock_files.values():
+            lock_file.close()
+        self.lock_files = {}
+
+    def checkout(self, layers, apply_pulls):
+        """
+        Return path of the worktree for _layers_, creating it if needed.
+
+        :param layers: List of (name, repo_dir, rel_dir, base, pull_nos).
+        :param apply_pulls: Function applying pull requests, called as
+                            apply_pulls(path, name, pull_nos).
+        """
+        key = self.key(layers)
+        path = self.path(key)
+        ready = path + '.ready'
+        self.lock(key, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(ready):
+                print 'Reusing worktree %s' % path
+                for _, _, rel_dir, _, pull_nos in layers:
+                    if pull_nos or not rel_dir:
+                        utils.run('cd %s && git reset -q --hard' %
+                                  os.path.join(path, rel_dir))
+            else:
+                print 'Creating worktree %s' % path
+                self.remove(path)
+                try:
+                    for name, repo_dir, rel_dir, base, pull_nos in layers:
+                        layer_dir = os.path.join(path, rel_dir).rstrip('/')
+                        parent_dir = os.path.dirname(layer_dir)
+                        if not os.path.isdir(parent_dir):
+                            os.makedirs(parent_dir)
+                        if rel_dir and not pull_nos:
+                            os.symlink(repo_dir, layer_dir)
+                            continue
+                        utils.run('cd %s && git worktree add --detach %s %s'
+                                  % (repo_dir, layer_dir, base))
+                        if pull_nos:
+                            apply_pulls(layer_dir, name,
+                                        sorted(pull_nos, key=int))
+                except Exception:
+                    self.remove(path)
+                    raise
+                open(ready, 'w').close()
+            os.utime(ready, None)
+        finally:
+            self.lock(key, fcntl.LOCK_SH)
+        return path
+
+    def sync(self, src_dir, dst_dir):
+        """
+        Bring ignored files, like the configs generated by bootstrap and
+        the data directory, from the original checkout into a worktree.
+
+        Files are copied when newer, directories and symlinks are linked.
+        """
+        res = utils.run('cd %s && git ls-files --others --ignored '
+                        '--exclude-standard --directory' % src_dir,
+                        ignore_status=True)
+        for entry in res.stdout.splitlines():
+            if entry.endswith('.pyc'):
+                continue
+            src = os.path.join(src_dir, entry.rstrip('/'))
+            dst = os.path.join(dst_dir, entry.rstrip('/'))
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            if os.path.islink(src) or os.path.isdir(src):
+                if not os.path.lexists(dst):
+                    os.symlink(os.path.realpath(src), dst)
+                elif os.path.isdir(dst) and not os.path.islink(dst):
+                    # Partly populated by a nested layer
+                    for name in os.listdir(src):
+                        if not os.path.lexists(os.path.join(dst, name)):
+                            os.symlink(os.path.realpath(
+                                os.path.join(src, name)),
+                                os.path.join(dst, name))
+            elif os.path.isfile(src):
+                if (not os.path.exists(dst) or
+                        os.path.getmtime(src) > os.path.getmtime(dst)):
+                    shutil.copy2(src, dst)
+
+    def remove(self, path):
+        """
+        Remove a worktree directory and its git administrative files.
+        """
+        if os.path.lexists(path + '.ready'):
+            os.remove(path + '.ready')
+        if os.path.isdir(path):
+            repos = set()
+            for top, dirs, _ in os.walk(path):
+                if '.git' in os.listdir(top):
+                    git_file = os.path.join(top, '.git')
+                    if os.path.isfile(git_file):
+                        with open(git_file) as fp:
+                            gitdir = fp.read().split(':', 1)[1].strip()
+                        repos.add(os.path.dirname(os.path.dirname(gitdir)))
+                dirs[:] = [name for name in dirs if name != '.git' and
+                           not os.path.islink(os.path.join(top, name))]
+            shutil.rmtree(path)
+            for repo in repos:
+                utils.run('cd %s && git worktree prune' % repo,
+                          ignore_status=True)
+
+    def prune(self, keep):
+        """
+        Remove least recently used worktrees not in use, keeping _keep_.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        readies = [os.path.join(self.cache_dir, name)
+                   for name in os.listdir(self.cache_dir)
+                   if name.endswith('.ready')]
+        readies.sort(key=os.path.getmtime, reverse=True)
+        for ready in readies[keep:]:
+            key = os.path.basename(ready)[:-len('.ready')]
+            if key in self.lock_files:
+                continue
+            with open(self.path(key) + '.lock', 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue
+                print 'Removing unused worktree %s' % self.path(key)
+                self.remove(self.path(key))
+
+
+class ImpactIndex():
+
+    """
+    Map changed files to the tests they could affect.
+
+    The index records the variant prefixes of every `type =` line in
+    tp-libvirt cfg files and the import graph of test sources, provider
+    helpers and virttest modules. A changed file affects the tests whose
+    type module imports it, directly or indirectly.
+
+    Changed files are given as (repo_name, path) with repo_name being
+    'virt-test' or 'tp-libvirt'.
+    """
+    cfg_dir = 'libvirt/tests/cfg'
+    src_dir = 'libvirt/tests/src'
+    doc_re = re.compile(r'(^|/)(README[^/]*|[^/]*\.(md|rst)|COPYING|LICENSE)$')
+
+    def __init__(self, virt_dir, tp_dir):
+        self.virt_dir = virt_dir
+        self.tp_dir = tp_dir
+        # 'repo:path' -> module name
+        self.files = {}
+        # module name -> names of imported modules
+        self.imports = {}
+        # 'tp-libvirt:path' -> prefixes of variants defined in a cfg
+        self.cfgs = {}
+        # test type -> prefixes of variants with this type
+        self.types = {}
+
+    def key(self):
+        """
+        Return a key changing with commits and local changes of the repos.
+        """
+        sha = hashlib.sha1()
+        for repo in (self.virt_dir, self.tp_dir):
+            res = utils.run('cd %s && git rev-parse HEAD && git diff HEAD'
+                            % repo, ignore_status=True)
+            sha.update(res.stdout + '\0')
+        return sha.hexdigest()
+
+    def load(self, cache_dir):
+        """
+        Load the index cached for current commits, or build and cache it.
+        """
+        cache_file = os.path.join(cache_dir, self.key() + '.json')
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file) as fp:
+                    data = json.load(fp)
+                self.files = data['files']
+                self.imports = data['imports']
+                self.cfgs = data['cfgs']
+                self.types = data['types']
+                return
+            except (ValueError, KeyError), e:
+                print 'Warning: Rebuilding broken impact index %s: %s' % (
+                    cache_file, e)
+        self.build()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_file + '.tmp', 'w') as fp:
+            json.dump({'files': self.files, 'imports': self.imports,
+                       'cfgs': self.cfgs, 'types': self.types}, fp)
+        os.rename(cache_file + '.tmp', cache_file)
+
+    def build(self):
+        """
+        Build the index by parsing cfg and python files.
+        """
+        modules = {}
+        for repo_name, repo_dir, top in (
+                ('virt-test', self.virt_dir, 'virttest'),
+                ('tp-libvirt', self.tp_dir, 'provider'),
+                ('tp-libvirt', self.tp_dir, self.src_dir)):
+            for dirpath, dirs, files in os.walk(os.path.join(repo_dir, top)):
+                dirs.sort()
+                for name in sorted(files):
+                    if not name.endswith('.py'):
+                        continue
+                    path = os.path.relpath(os.path.join(dirpath, name),
+                                           repo_dir)
+                    if top == self.src_dir:
+                        module = 'test:' + path
+                    else:
+                        module = path[:-3].replace('/', '.')
+                        if module.endswith('.__init__'):
+                            module = module[:-len('.__init__')]
+                    self.files['%s:%s' % (repo_name, path)] = module
+                    modules[module] = os.path.join(repo_dir, path)
+
+        for module, path in modules.items():
+            package = None
+            if not module.startswith('test:'):
+                package = module.rsplit('.', 1)[0] if '.' in module else None
+                if path.endswith('__init__.py'):
+                    package = module
+            self.imports[module] = sorted(
+                self.parse_imports(path, package, modules))
+
+        cfg_top = os.path.join(self.tp_dir, self.cfg_dir)
+        for dirpath, dirs, files in os.walk(cfg_top):
+            for name in files:
+                if not name.endswith('.cfg'):
+                    continue
+                path = os.path.join(dirpath, name)
+                prefixes = set()
+                for test_type, prefix in self.parse_cfg(path):
+                    prefixes.add(prefix)
+                    if test_type:
+                        self.types.setdefault(test_type, [])
+                        if prefix not in self.types[test_type]:
+                            self.types[test_type].append(prefix)
+                self.cfgs['tp-libvirt:' + os.path.relpath(
+                    path, self.tp_dir)] = sorted(prefixes)
+
+    def parse_imports(self, path, package, modules):
+        """
+        Return names of indexed modules imported by a python file.
+        """
+        def resolve(name):
+            names = []
+            if package:
+                # Implicit relative import
+                names.append('%s.%s' % (package, name))
+            names.append(name)
+            for full_name in names:
+                if full_name in modules:
+                    return full_name
+            return None
+
+        try:
+            with open(path) as fp:
+                tree = ast.parse(fp.read(), path)
+        except (SyntaxError, TypeError), e:
+            print 'Warning: Failed to parse imports of %s: %s' % (path, e)
+            return set()
+
+        imported = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    imported.add(resolve(alias.name))
+            elif isinstance(node, ast.ImportFrom):
+                module_name = node.module or ''
+                if node.level:
+                    base = (package or '').split('.')
+                    base = base[:len(base) - node.level + 1]
+                    module_name = '.'.join(base + [module_name]).strip('.')
+                    resolved = (module_name if module_name in modules
+                                else None)
+                else:
+                    resolved = resolve(module_name)
+                for alias in node.names:
+                    sub_name = resolve('%s.%s' % (resolved or module_name,
+                                                  alias.name))
+                    imported.add(sub_name or resolved)
+        imported.discard(None)
+        # Importing a module runs __init__ of its packages
+        for name in list(imported):
+            while '.' in name:
+                name = name.rsplit('.', 1)[0]
+                if name in modules:
+                    imported.add(name)
+        return imported
+
+    def parse_cfg(self, path):
+        """
+        Return (type, variant prefix) of every `type =` line in a cfg file,
+        and (None, prefix) of its top variant.
+        """
+        results = []
+        stack = []
+        with open(path) as fp:
+            for line in fp:
+                stripped = line.strip()
+                if not stripped or stripped.startswith('#'):
+                    continue
+                indent = len(line) - len(line.lstrip())
+                while stack and stack[-1][0] >= indent:
+                    stack.pop()
+                match = re.match(r'-\s*([^\s:]+)\s*:', stripped)
+                if match:
+                    stack.append((indent, match.group(1)))
+                    if len(stack) == 1:
+                        results.append((None, match.group(1).lstrip('@')))
+                    continue
+                match = re.match(r'type\s*=\s*(\S+)', stripped)
+                if match and stack:
+                    prefix = '.'.join(name for _, name in stack
+                                      if not name.startswith('@'))
+                    results.append((match.group(1), prefix))
+        return results
+
+    def affected(self, changes):
+        """
+        Return variant prefixes of tests affected by changed files, or
+        None when some change can't be mapped and every test could break.
+        """
+        users = {}
+        for module, imported in self.imports.items():
+            for name in imported:
+                users.setdefault(name, set()).add(module)
+
+        prefixes = set()
+        for repo_name, path in changes:
+            if self.doc_re.search(path):
+                continue
+            tagged = '%s:%s' % (repo_name, path)
+            if tagged in self.cfgs:
+                prefixes |= set(self.cfgs[tagged])
+                continue
+            module = self.files.get(tagged)
+            if module is None:
+                print 'Change of %s affects all tests' % tagged
+                return None
+            seen = set([module])
+            pending = [module]
+            while pending:
+                for user in users.get(pending.pop(), ()):
+                    if user not in seen:
+                        seen.add(user)
+                        pending.append(user)
+            test_modules = [name for name in seen if name.startswith('test:')]
+            if not test_modules:
+                print 'Change of %s affects all tests' % tagged
+                return None
+            for name in test_modules:
+                test_type = os.path.basename(name)[:-len('.py')]
+                prefixes |= set(self.types.get(test_type, []))
+        return prefixes
+
+
+class WarmRunner():
+
+    """
+    A long-lived process running ./run invocations in forked children.
+
+    The daemon imports virttest, the test provider and parses the main
+    Cartesian config once. Each request forks a child that executes the
+    ./run script in place, so a test skips interpreter start-up and
+    module imports. Requests are JSON lines over a local unix socket:
+
+        {"argv": [...], "log": path, "cwd": dir} -> {"pid": pid}
+                                                    {"exit_status": status}
+        {"shutdown": true}
+
+    Output of a child, with stderr merged, goes to the requested log.
+    """
+    preload_modules = ['virttest.standalone_test',
+                       'virttest.cartesian_config',
+                       'virttest.env_process',
+                       'virttest.libvirt_vm',
+                       'virttest.virsh',
+                       'virttest.utils_misc']
+    start_timeout = 120
+
+    def __init__(self, root_dir, log_path, config=None, provider_dir=None,
+                 memo_config=False):
+        """
+        :param root_dir: virt-test directory holding the ./run script.
+        :param log_path: Log file of the daemon itself.
+        :param config: Main Cartesian config to parse in advance.
+        :param provider_dir: tp-libvirt directory to preload modules from.
+        :param memo_config: Whether to reuse the parsed config in tests.
+        """
+        self.root_dir = root_dir
+        self.log_path = log_path
+        self.config = config
+        self.provider_dir = provider_dir
+        self.memo_config = memo_config
+        self.socket_path = None
+        self.proc = None
+        # Parsed config nodes keyed by (path, mtime, defaults)
+        self.parse_memo = {}
+
+    def start(self):
+        """
+        Start the daemon and wait until it accepts requests.
+
+        :return: True if the daemon is ready.
+        """
+        self.socket_path = os.path.join(
+            tempfile.mkdtemp(prefix='warm-runner-'), 'socket')
+        options = {'root_dir': self.root_dir, 'config': self.config,
+                   'provider_dir': self.provider_dir,
+                   'memo_config': self.memo_config,
+                   'socket_path': self.socket_path}
+        with open(self.log_path, 'w') as log:
+            self.proc = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__),
+                 '--warm-runner-daemon', json.dumps(options)],
+                stdin=open(os.devnull), stdout=log, stderr=subprocess.STDOUT,
+                cwd=self.root_dir, close_fds=True)
+        deadline = time.time() + self.start_timeout
+        while time.time() < deadline and self.proc.poll() is None:
+            try:
+                self.connect().close()
+                return True
+            except socket.error:
+                time.sleep(0.1)
+        self.stop()
+        return False
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        return sock
+
+    def submit(self, argv, log_path, cwd):
+        """
+        Start a ./run invocation in the daemon.
+
+        :return: A (sock, pid) tuple. The exit status of the child can be
+                 read from _sock_ with wait().
+        """
+        sock = self.connect()
+        sock.sendall(json.dumps({'argv': argv, 'log': log_path,
+                                 'cwd': cwd}) + '\n')
+        reply = self.read_reply(sock)
+        if 'pid' not in reply:
+            sock.close()
+            raise RuntimeError('Warm runner refused request: %s' % reply)
+        return sock, reply['pid']
+
+    def read_reply(self, sock):
+        data = ''
+        while not data.endswith('\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return json.loads(data) if data.strip() else {}
+
+    def wait(self, sock):
+        """
+        Wait for the exit status of a child started by submit().
+        """
+        try:
+            return self.read_reply(sock).get('exit_status')
+        finally:
+            sock.close()
+
+    def stop(self):
+        """
+        Shut down the daemon and remove its socket.
+        """
+        if self.proc is not None and self.proc.poll() is None:
+            try:
+                sock = self.connect()
+                sock.sendall(json.dumps({'shutdown': True}) + '\n')
+                sock.close()
+            except socket.error:
+                pass
+            deadline = time.time() + 10
+            while time.time() < deadline and self.proc.poll() is None:
+                time.sleep(0.1)
+            if self.proc.poll() is None:
+                self.proc.kill()
+                self.proc.wait()
+        if self.socket_path:
+            shutil.rmtree(os.path.dirname(self.socket_path),
+                          ignore_errors=True)
+
+    def preload(self):
+        """
+        Import test modules and parse the config in the daemon.
+        """
+        for name in list(sys.modules):
+            if name == 'virttest' or name.startswith('virttest.'):
+                del sys.modules[name]
+        sys.path.insert(0, self.root_dir)
+        for name in self.preload_modules:
+            try:
+                __import__(name)
+            except Exception, e:
+                print 'Failed to preload %s: %s' % (name, e)
+        if self.provider_dir:
+            package_dir = os.path.join(self.provider_dir, 'provider')
+            if os.path.isdir(package_dir):
+                sys.path.insert(1, self.provider_dir)
+                for name in sorted(os.listdir(package_dir)):
+                    if name.endswith('.py') and name != '__init__.py':
+                        try:
+                            __import__('provider.' + name[:-len('.py')])
+                        except Exception, e:
+                            print 'Failed to preload provider %s: %s' % (
+                                name, e)
+                sys.path.remove(self.provider_dir)
+        if self.memo_config and self.config:
+            try:
+                self.memoize_parser()
+                from virttest import cartesian_config
+                cartesian_config.Parser(self.config)
+            except Exception, e:
+                print 'Failed to parse %s: %s' % (self.config, e)
+        sys.stdout.flush()
+
+    def memoize_parser(self):
+        """
+        Make Cartesian config parsers reuse nodes parsed by the daemon.
+
+        A fresh parser parsing a known file gets the node parsed in the
+        daemon. Children only modify their copy-on-write copies of it.
+        Included files are not tracked, so the memo only lives as long as
+        the daemon.
+        """
+        from virttest import cartesian_config
+        parse_file = cartesian_config.Parser.parse_file
+        memo = self.parse_memo
+        daemon_pid = os.getpid()
+
+        def memo_parse_file(parser, cfgfile):
+            node = parser.node
+            fresh = not (node.content or node.children)
+            path = os.path.abspath(cfgfile)
+            try:
+                key = (path, os.path.getmtime(path),
+                       getattr(parser, 'defaults', None))
+            except OSError:
+                key = None
+            if fresh and key in memo:
+                parser.node = memo[key]
+                return
+            parse_file(parser, cfgfile)
+            if fresh and key is not None and os.getpid() == daemon_pid:
+                memo[key] = parser.node
+
+        cartesian_config.Parser.parse_file = memo_parse_file
+
+    def serve(self):
+        """
+        Accept requests until shut down or the parent process exits.
+
+        Exits of children wake up the loop through a SIGCHLD self-pipe,
+        so they are replied at once. The select timeout only bounds the
+        detection of the parent exit.
+        """
+        self.preload()
+        wake_r, wake_w = os.pipe()
+        for fd in (wake_r, wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(wake_w)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(16)
+        parent_pid = os.getppid()
+        # Connections waiting for a request, and their partial data
+        pending = {}
+        # Connections waiting for the exit of a child, keyed by pid
+        children = {}
+        print 'Warm runner ready on %s' % self.socket_path
+        sys.stdout.flush()
+        while os.getppid() == parent_pid:
+            try:
+                readable, _, _ = select.select(
+                    [listener, wake_r] + list(pending), [], [], 1)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            for sock in readable:
+                if sock is wake_r:
+                    try:
+                        while os.read(wake_r, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                if sock is listener:
+                    conn, _ = listener.accept()
+                    pending[conn] = ''
+                    continue
+                data = sock.recv(65536)
+                if not data:
+                    del pending[sock]
+                    sock.close()
+                    continue
+                pending[sock] += data
+                if not pending[sock].endswith('\n'):
+                    continue
+                request = json.loads(pending.pop(sock))
+                if request.get('shutdown'):
+                    sock.close()
+                    listener.close()
+                    return
+                try:
+                    pid = self.fork_run(request)
+                except Exception, e:
+                    sock.sendall(json.dumps({'error': str(e)}) + '\n')
+                    sock.close()
+                    continue
+                sock.sendall(json.dumps({'pid': pid}) + '\n')
+                children[pid] = sock
+            while children:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError:
+                    break
+                if not pid:
+                    break
+                if os.WIFSIGNALED(status):
+                    exit_status = -os.WTERMSIG(status)
+                else:
+                    exit_status = os.WEXITSTATUS(status)
+                sock = children.pop(pid, None)
+                if sock is not None:
+                    try:
+                        sock.sendall(json.dumps(
+                            {'exit_status': exit_status}) + '\n')
+                    except socket.error:
+                        pass
+                    sock.close()
+        listener.close()
+
+    def fork_run(self, request):
+        """
+        Fork a child executing the ./run script with the request argv.
+        """
+        log_fd = os.open(str(request['log']),
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        pid = os.fork()
+        if pid:
+            os.close(log_fd)
+            return pid
+        status = 1
+        try:
+            os.setsid()
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            null_fd = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(null_fd, 0)
+            os.dup2(log_fd, 1)
+            os.dup2(log_fd, 2)
+            # Drop the listener and connections of other requests
+            os.closerange(3, subprocess.MAXFD)
+            cwd = str(request['cwd'])
+            os.chdir(cwd)
+            script = os.path.join(cwd, 'run')
+            sys.argv = [script] + [str(arg) for arg in request['argv']]
+            sys.path[0] = cwd
+            try:
+                runpy.run_path(script, run_name='__main__')
+                status = 0
+            except SystemExit, e:
+                if e.code is None:
+                    status = 0
+                elif isinstance(e.code, int):
+                    status = e.code
+                else:
+                    print >> sys.stderr, e.code
+                    status = 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+
+
+def is_qcow2(path):
+    """
+    Return whether _path_ is a qcow2 image.
+    """
+    with open(path) as fp:
+        return fp.read(4) == 'QFI\xfb'
+
+
+def create_overlay(path, base):
+    """
+    Create a qcow2 overlay backed by the qcow2 image _base_ at _path_.
+    """
+    if os.path.lexists(path):
+        os.remove(path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    utils.run('qemu-img create -f qcow2 -o backing_file=%s,'
+              'backing_fmt=qcow2 %s' % (base, path))
+
+
+class WorkerSlot():
+
+    """
+    An isolated environment for running tests in parallel.
+
+    Each slot owns a clone of every test VM, a Cartesian config file
+    pointing tests to these clones, a private tmp directory and a private
+    data directory.
+
+    The data directory links to the entries of the shared one, except
+    for 'images' which is a directory of its own, so images created or
+    removed by a test stay in the slot. Each qcow2 image in it is an
+    overlay of the shared image, other writable files are copied and
+    only read-only ones are linked. Tests calling
+    data_dir.get_data_dir() directly instead of using 'images_base_dir'
+    still share the data directory.
+    """
+
+    def __init__(self, index, vms, config):
+        self.index = index
+        self.vm_map = dict((vm, '%s-w%d' % (vm, index)) for vm in vms)
+        self.vms = [self.vm_map[vm] for vm in vms]
+        self.root_dir = os.path.join(data_dir.get_data_dir(),
+                                     'workers', str(index))
+        self.tmp_dir = os.path.join(self.root_dir, 'tmp')
+        self.data_dir = os.path.join(self.root_dir, 'data')
+        self.cfg = os.path.join(self.root_dir, 'worker.cfg')
+        self.config = config
+
+    def prepare(self):
+        """
+        Create directories and config file of the slot.
+        """
+        if os.path.isdir(self.root_dir):
+            shutil.rmtree(self.root_dir)
+        os.makedirs(self.tmp_dir)
+        shared_dir = data_dir.get_data_dir()
+        os.makedirs(os.path.join(self.data_dir, 'images'))
+        for entry in os.listdir(shared_dir):
+            if entry in ['images', 'workers']:
+                continue
+            os.symlink(os.path.join(shared_dir, entry),
+                       os.path.join(self.data_dir, entry))
+        images_dir = os.path.join(shared_dir, 'images')
+        if os.path.isdir(images_dir):
+            for entry in os.listdir(images_dir):
+                # Disks of the clones of any slot
+                if [vm for vm in self.vm_map if entry.startswith(vm + '-w')]:
+                    continue
+                src = os.path.realpath(os.path.join(images_dir, entry))
+                dst = os.path.join(self.data_dir, 'images', entry)
+                if os.path.isdir(src):
+                    shutil.copytree(src, dst, symlinks=True)
+                elif is_qcow2(src):
+                    create_overlay(dst, src)
+                elif not os.stat(src).st_mode & 0222:
+                    os.symlink(src, dst)
+                else:
+                    shutil.copy2(src, dst)
+        with open(self.cfg, 'w') as fp:
+            fp.write('include %s\n' % self.config)
+            fp.write('images_base_dir = %s\n' % self.data_dir)
+            fp.write('vms = %s\n' % ' '.join(self.vms))
+            fp.write('main_vm = %s\n' % self.vms[0])
+
+    def wrap_cmd(self, cmd):
+        """
+        Make a ./run command line use this slot.
+        """
+        return 'TMPDIR=%s %s -c %s' % (self.tmp_dir, cmd, self.cfg)
+
+    def remove_vms(self):
+        """
+        Destroy and undefine the VMs of the slot with their storage.
+        """
+        for vm in self.vms:
+            virsh.destroy(vm, ignore_status=True)
+            virsh.undefine(vm, '--snapshots-metadata --remove-all-storage',
+                           ignore_status=True)
+
+    def cleanup(self):
+        """
+        Remove the VMs and directories of the slot.
+        """
+        self.remove_vms()
+        if os.path.isdir(self.root_dir):
+            shutil.rmtree(self.root_dir)
+
+
+class VMSnapshot():
+
+    """
+    An internal snapshot of a test VM, taken after the environment is
+    prepared and reverted to instead of repairing the VM after a test.
+
+    The snapshot XML is saved to _xml_path_, so the snapshot can be
+    redefined when a test or a restore dropped the snapshot metadata,
+    as disk snapshots survive in the qcow2 image.
+    """
+    name = 'virt-test-ci-clean'
+
+    def __init__(self, vm, xml_path, uri=None):
+        self.vm = vm
+        self.xml_path = xml_path
+        self.uri = uri
+
+    def create(self):
+        """
+        Take the snapshot and save its XML.
+        """
+        virsh.snapshot_delete(self.vm, self.name, ignore_status=True,
+                              uri=self.uri)
+        res = virsh.snapshot_create_as(self.vm, '%s --atomic' % self.name,
+                                       uri=self.uri)
+        if res.exit_status:
+            raise Exception(str(res))
+        res = virsh.snapshot_dumpxml(self.vm, self.name, uri=self.uri)
+        if res.exit_status:
+            raise Exception(str(res))
+        dirname = os.path.dirname(self.xml_path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(self.xml_path, 'w') as fp:
+            fp.write(res.stdout)
+
+    def redefine(self):
+        """
+        Define the VM and the snapshot metadata again from the saved XML.
+        """
+        if not virsh.domain_exists(self.vm, uri=self.uri):
+            root = ElementTree.parse(self.xml_path).getroot()
+            domain_file = tempfile.NamedTemporaryFile(delete=False)
+            domain_file.write(ElementTree.tostring(root.find('domain')))
+            domain_file.close()
+            try:
+                res = virsh.define(domain_file.name, uri=self.uri)
+            finally:
+                os.remove(domain_file.name)
+            if res.exit_status:
+                raise Exception(str(res))
+        res = virsh.snapshot_create(
+            self.vm, '--redefine %s --current' % self.xml_path, uri=self.uri)
+        if res.exit_status:
+            raise Exception(str(res))
+
+    def revert(self):
+        """
+        Revert the VM to the snapshot, redefining it first if needed.
+        """
+        res = virsh.snapshot_revert(self.vm, self.name, '--force',
+                                    uri=self.uri)
+        if res.exit_status:
+            self.redefine()
+            res = virsh.snapshot_revert(self.vm, self.name, '--force',
+                                        uri=self.uri)
+            if res.exit_status:
+                raise Exception(str(res))
+
+    def delete(self):
+        virsh.snapshot_delete(self.vm, self.name, ignore_status=True,
+                              uri=self.uri)
 
 
 class LibvirtCI():
+    # Tracer recording phases of the run
+    tracer = Tracer()
+    # Seconds to read output left after a command exited
+    drain_timeout = 2
 
     def parse_args(self):
         parser = optparse.OptionParser(
@@ -774,6 +3752,16 @@ class LibvirtCI():
         parser.add_option('--report', dest='report', action='store',
                           default='xunit_result.xml',
                           help='Exclude specified tests.')
+        parser.add_option('--resume', dest='resume', action='store_true',
+                          help='Skip tests completed by an interrupted run '
+                          'and rebuild their results into the report. '
+                          'Implies --stream-report')
+        parser.add_option('--stream-report', dest='stream_report',
+                          action='store_true', help='Append each test result '
+                          'to a journal and write the report only at the end.')
+        parser.add_option('--rebuild-report', dest='rebuild_report',
+                          action='store_true', help='Rebuild the report from '
+                          'the journal of an interrupted streaming run.')
         parser.add_option('--white', dest='whitelist', action='store',
                           default='', help='Whitelist file contains '
                           'specified test cases to run.')
@@ -806,8 +3794,22 @@ class LibvirtCI():
                           action='store_true',
                           help='Merge virt-test pull requests depend on')
         parser.add_option('--no-restore-pull', dest='no_restore_pull',
-                          action='store_true', help='Do not restore repo '
-                          'to branch master after test.')
+                          action='store_true', help='Do not remove unused '
+                          'pull request worktrees after test.')
+        parser.add_option('--worktree-keep', dest='worktree_keep',
+                          action='store', default='10',
+                          help='Number of cached pull request worktrees to '
+                          'keep')
+        parser.add_option('--github-api', dest='github_api', action='store',
+                          default='https://api.github.com',
+                          help='Base URL of GitHub API, can be a local '
+                          'fixture server')
+        parser.add_option('--github-url', dest='github_url', action='store',
+                          default='https://github.com',
+                          help='Base URL to fetch pull request patches')
+        parser.add_option('--github-ttl', dest='github_ttl', action='store',
+                          default='300', help='Seconds to use cached GitHub '
+                          'responses before revalidating them')
         parser.add_option('--only-change', dest='only_change',
                           action='store_true', help='Only test tp-libvirt '
                           'test cases related to changed files.')
@@ -826,7 +3828,116 @@ class LibvirtCI():
         parser.add_option('--timeout', dest='timeout',
                           action='store', default='1200',
                           help='Maximum run time for one test case')
+        parser.add_option('--no-list-cache', dest='no_list_cache',
+                          action='store_true', help='Always list tests by '
+                          './run instead of using cached test lists')
+        parser.add_option('--golden-image', dest='golden_image',
+                          action='store_true', help='Install the test VM '
+                          'once into a cached golden image and create VMs '
+                          'as qcow2 overlays of it')
+        parser.add_option('--golden-dir', dest='golden_dir', action='store',
+                          default='/var/lib/libvirt/images/virt-test-ci-golden',
+                          help='Directory of cached golden images')
+        parser.add_option('--idle-timeout', dest='idle_timeout',
+                          action='store', default='0', help='Kill a test '
+                          'printing nothing for this many seconds, 0 to '
+                          'disable')
+        parser.add_option('--history-timeout', dest='history_timeout',
+                          action='store', default='3', help='Kill a test '
+                          'running longer than this multiple of its 95th '
+                          'percentile duration in history, 0 to disable')
+        parser.add_option('--min-timeout', dest='min_timeout',
+                          action='store', default='60', help='Minimum '
+                          'timeout of a test derived from history')
+        parser.add_option('--fatal-pattern', dest='fatal_patterns',
+                          action='append', default=[], help='Kill a test '
+                          'at once when its output matches this regex. '
+                          'Can be given multiple times')
+        parser.add_option('--log-dir', dest='log_dir', action='store',
+                          default='logs', help='Directory of the full '
+                          'output logs of each test')
+        parser.add_option('--jobs', dest='jobs', action='store', default='1',
+                          help='Number of tests run in parallel, each on '
+                          'its own clones of the test VMs')
+        parser.add_option('--deep-dir-check', dest='deep_dir_check',
+                          action='store_true', help='Check metadata of all '
+                          'files under watched directories recursively and '
+                          'restore changed files from a backup')
+        parser.add_option('--dir-backup-limit', dest='dir_backup_limit',
+                          action='store', default=str(10 * 1024 * 1024),
+                          help='Maximum size in bytes of a file backed up '
+                          'for --deep-dir-check, size and mtime changes of '
+                          'larger files are permitted')
+        parser.add_option('--inotify', dest='inotify', action='store_true',
+                          help='Watch files and directories with inotify and '
+                          'check only those changed by a test')
+        parser.add_option('--virsh-state', dest='virsh_state',
+                          action='store_true', help='Collect libvirt states '
+                          'by virsh commands instead of libvirt API')
+        parser.add_option('--batch-size', dest='batch_size', action='store',
+                          default='1', help='Run up to this number of tests '
+                          'of the same class in one ./run invocation, '
+                          'checking states after each batch')
+        parser.add_option('--vm-snapshot', dest='vm_snapshot',
+                          action='store', default='off',
+                          choices=['off', 'diff', 'always'],
+                          help='Snapshot test VMs after preparing the '
+                          'environment and revert to it after every test '
+                          '(always), or after tests failing or changing the '
+                          'VMs when faster than repairing them (diff)')
+        parser.add_option('--trace', dest='trace', action='store',
+                          default='', help='Save timings of harness phases '
+                          'to this Chrome trace JSON file and print a '
+                          'summary of them')
+        parser.add_option('--profile', dest='profile', action='store',
+                          default='', help='Profile the harness process '
+                          'with cProfile and save stats to this file')
+        parser.add_option('--warm-runner', dest='warm_runner',
+                          action='store_true', help='Run tests in children '
+                          'forked from a process with virttest and the test '
+                          'provider imported in advance')
+        parser.add_option('--cfg-memo', dest='cfg_memo', action='store_true',
+                          help='Parse the Cartesian config once in the warm '
+                          'runner and reuse it in every test')
+        parser.add_option('--mount-scope', dest='mount_scope', action='store',
+                          default='', help='Check only these mount points '
+                          'and their sub-mounts, separated by ",", example: '
+                          '--mount-scope /mnt,/var/lib/libvirt')
+        parser.add_option('--cache-dir', dest='cache_dir', action='store',
+                          default='~/.cache/virt-test-ci',
+                          help='Directory for data kept between runs')
+        parser.add_option('--history', dest='history', action='store',
+                          default='', help='File recording test durations, '
+                          'default to history.json in cache dir')
+        parser.add_option('--shard', dest='shard', action='store',
+                          default='', help='Run only a shard of tests '
+                          'balanced by historical duration, example: '
+                          '--shard 2/4 runs the second of four shards. All '
+                          'hosts must share the same --history file, tests '
+                          'are split by name only otherwise')
         self.args, self.real_args = parser.parse_args()
+        # Tests may run from a pull request worktree, so outputs are
+        # resolved against the original checkout before changing into it
+        root_dir = data_dir.get_root_dir()
+        for option in ['report', 'log_dir', 'trace', 'profile', 'history',
+                       'cache_dir']:
+            path = getattr(self.args, option)
+            if path:
+                path = os.path.join(root_dir, os.path.expanduser(path))
+                setattr(self.args, option, path)
+        if self.args.shard:
+            try:
+                index, count = [int(n) for n in self.args.shard.split('/')]
+            except ValueError:
+                parser.error('--shard must be like 2/4')
+            if not 1 <= index <= count:
+                parser.error('--shard index must be between 1 and %d'
+                             % count)
+        # A history given explicitly may be shared by all shard hosts
+        self.shared_history = bool(self.args.history)
+        if not self.args.history:
+            self.args.history = os.path.join(self.args.cache_dir,
+                                             'history.json')
 
     def prepare_tests(self, whitelist='whitelist.test',
                       blacklist='blacklist.test'):
@@ -850,9 +3961,36 @@ class LibvirtCI():
             except IOError:
                 return None
 
+        def list_cache_key(cmd):
+            """
+            Return a key of the test list, which changes whenever the
+            command line, the repos or the configs change.
+            """
+            sha = hashlib.sha1()
+            sha.update(cmd + '\0')
+            for repo in (self.root_dir, self.provider_dir()):
+                res = utils.run('cd %s && git rev-parse HEAD && git diff HEAD'
+                                % repo, ignore_status=True)
+                sha.update(res.stdout + '\0')
+            cfgs = [self.args.config]
+            for cfg_dir in ('backends/libvirt/cfg', 'shared/cfg'):
+                cfg_dir = os.path.join(self.root_dir, cfg_dir)
+                if os.path.isdir(cfg_dir):
+                    cfgs += [os.path.join(cfg_dir, name)
+                             for name in sorted(os.listdir(cfg_dir))
+                             if name.endswith('.cfg')]
+            for cfg in cfgs:
+                if cfg and os.path.isfile(cfg):
+                    with open(cfg) as fp:
+                        sha.update(fp.read())
+                sha.update('\0')
+            return sha.hexdigest()
+
         def get_all_tests():
             """
             Get all libvirt tests.
+
+            The output of listing tests is cached in cache dir.
             """
             if type(self.onlys) == set and not self.onlys:
                 return []
@@ -861,13 +3999,28 @@ class LibvirtCI():
             if self.args.connect_uri:
                 cmd += ' --connect-uri %s' % self.args.connect_uri
             if self.nos:
-                cmd += ' --no %s' % ','.join(self.nos)
+                cmd += ' --no %s' % ','.join(sorted(self.nos))
             if self.onlys:
-                cmd += ' --tests %s' % ','.join(self.onlys)
+                cmd += ' --tests %s' % ','.join(sorted(self.onlys))
             if self.args.config:
                 cmd += ' -c %s' % self.args.config
-            res = utils.run(cmd)
-            out, err, exitcode = res.stdout, res.stderr, res.exit_status
+
+            cache_file = None
+            if not self.args.no_list_cache:
+                cache_file = os.path.join(self.args.cache_dir, 'test-lists',
+                                          list_cache_key(cmd) + '.txt')
+            if cache_file and os.path.exists(cache_file):
+                with open(cache_file) as fp:
+                    out = fp.read()
+            else:
+                res = utils.run(cmd)
+                out, err, exitcode = res.stdout, res.stderr, res.exit_status
+                if cache_file:
+                    if not os.path.isdir(os.path.dirname(cache_file)):
+                        os.makedirs(os.path.dirname(cache_file))
+                    with open(cache_file + '.tmp', 'w') as fp:
+                        fp.write(out)
+                    os.rename(cache_file + '.tmp', cache_file)
             tests = []
             class_names = set()
             for line in out.splitlines():
@@ -884,29 +4037,6 @@ class LibvirtCI():
                         tests.append(test)
             return tests
 
-        def change_to_only(change_list):
-            """
-            Transform the content of a change file to a only set.
-            """
-            onlys = set()
-            for line in change_list:
-                filename = line.strip()
-                res = re.match('libvirt/tests/(cfg|src)/(.*).(cfg|py)',
-                               filename)
-                if res:
-                    cfg_path = 'libvirt/tests/cfg/%s.cfg' % res.groups()[1]
-                    tp_dir = data_dir.get_test_provider_dir(
-                        'io-github-autotest-libvirt')
-                    cfg_path = os.path.join(tp_dir, cfg_path)
-                    try:
-                        with open(cfg_path) as fcfg:
-                            only = fcfg.readline().strip()
-                            only = only.lstrip('-').rstrip(':').strip()
-                            onlys.add(only)
-                    except:
-                        pass
-            return onlys
-
         self.nos = set(['io-github-autotest-qemu'])
         self.onlys = None
 
@@ -935,10 +4065,17 @@ class LibvirtCI():
         if self.args.no:
             self.nos |= set(self.args.no.split(','))
         if self.args.only_change:
-            if self.onlys is not None:
-                self.onlys &= change_to_only(self.libvirt_file_changed)
-            else:
-                self.onlys = change_to_only(self.libvirt_file_changed)
+            changes = ([('virt-test', path) for path in self.virt_file_changed] +
+                       [('tp-libvirt', path)
+                        for path in self.libvirt_file_changed])
+            index = ImpactIndex(self.root_dir, self.provider_dir())
+            index.load(os.path.join(self.args.cache_dir, 'impact'))
+            change_onlys = index.affected(changes)
+            if change_onlys is not None:
+                if self.onlys is not None:
+                    self.onlys &= change_onlys
+                else:
+                    self.onlys = change_onlys
 
         if self.args.whitelist:
             tests = read_tests_from_file(whitelist)
@@ -949,7 +4086,22 @@ class LibvirtCI():
             black_tests = read_tests_from_file(blacklist)
             tests = [t for t in tests if t not in black_tests]
 
-        with open('run.test', 'w') as fp:
+        if self.args.shard:
+            index, count = [int(n) for n in self.args.shard.split('/')]
+            history = self.history
+            if not self.shared_history:
+                # Each host records only its own shard in its cache dir,
+                # so split by names, which all hosts agree on
+                print ('Warning: --shard without --history, splitting tests '
+                       'by name only')
+                history = TestHistory(None)
+            tests = history.shard(tests, index - 1, count)
+
+        if int(self.args.jobs) > 1:
+            tests = self.history.longest_first(tests)
+
+        with open(os.path.join(data_dir.get_root_dir(), 'run.test'),
+                  'w') as fp:
             for test in tests:
                 fp.write(test + '\n')
         return tests
@@ -1007,7 +4159,9 @@ class LibvirtCI():
         options.vt_config = None
 
         bootstrap.bootstrap(options=options, interactive=False)
-        os.chdir(data_dir.get_root_dir())
+        if self.root_dir != data_dir.get_root_dir():
+            self.worktrees.sync(data_dir.get_root_dir(), self.root_dir)
+        os.chdir(self.root_dir)
 
     def prepare_env(self):
         """
@@ -1046,10 +4200,19 @@ class LibvirtCI():
 
         print 'Running bootstrap'
         sys.stdout.flush()
-        self.bootstrap()
+        with self.tracer.span('bootstrap'):
+            self.bootstrap()
+
+        self.golden_dir = None
+        golden_dir = None
+        if self.args.golden_image and 'lxc' not in self.args.connect_uri:
+            golden_dir = os.path.join(self.args.golden_dir,
+                                      self.golden_key())
+        golden_ready = golden_dir and os.path.exists(
+            os.path.join(golden_dir, 'domain.xml'))
 
         restore_image = True
-        if self.args.img_url:
+        if self.args.img_url and not golden_ready:
             def progress_callback(count, block_size, total_size):
                 #percent = count * block_size * 100 / total_size
                 #sys.stdout.write("\rDownloaded %2.2f%%" % percent)
@@ -1085,7 +4248,11 @@ class LibvirtCI():
 
         print 'Installing VM',
         sys.stdout.flush()
-        if 'lxc' in self.args.connect_uri:
+        if golden_ready:
+            print 'from golden image %s' % golden_dir
+            self.golden_dir = golden_dir
+            self.define_golden_vm()
+        elif 'lxc' in self.args.connect_uri:
             cmd = 'virt-install --connect=lxc:/// --name virt-tests-vm1 --ram 500 --noautoconsole'
             try:
                 utils.run(cmd)
@@ -1099,111 +4266,807 @@ class LibvirtCI():
                 raise Exception('   ERROR: Failed to install guest \n %s' %
                                 res.stderr)
             virsh.destroy('virt-tests-vm1')
+            if golden_dir:
+                self.save_golden(golden_dir)
+                self.golden_dir = golden_dir
         if self.args.add_vms:
             for vm in self.args.add_vms.split(','):
-                cmd = 'virt-clone '
-                if self.args.connect_uri:
-                    cmd += '--connect=%s ' % self.args.connect_uri
-                cmd += '--original=virt-tests-vm1 '
-                cmd += '--name=%s ' % vm
-                cmd += '--auto-clone'
-                utils.run(cmd)
+                self.clone_vm('virt-tests-vm1', vm)
+
+    def golden_key(self):
+        """
+        Return a key identifying the golden image for current options.
+        """
+        sha = hashlib.sha1()
+        for value in (self.args.img_url, self.args.os_variant,
+                      self.args.password, self.args.connect_uri):
+            sha.update(value + '\0')
+        for cfg in (self.args.config, 'shared/cfg/guest-os/Linux.cfg',
+                    'shared/cfg/guest-os/Linux/JeOS/19.x86_64.cfg'):
+            if cfg and os.path.exists(cfg):
+                with open(cfg) as fp:
+                    sha.update(fp.read())
+            sha.update('\0')
+        return sha.hexdigest()[:16]
+
+    def golden_disk(self, domain_xml):
+        """
+        Return path of the first disk in a domain XML.
+        """
+        root = ElementTree.fromstring(domain_xml)
+        source = root.find("devices/disk[@device='disk']/source")
+        if source is None or not source.get('file'):
+            raise Exception('No file backed disk found in domain XML')
+        return source.get('file')
+
+    def create_overlay(self, path):
+        """
+        Create a qcow2 overlay backed by the golden image at _path_.
+        """
+        create_overlay(path, os.path.join(self.golden_dir, 'base.qcow2'))
+
+    def save_golden(self, golden_dir):
+        """
+        Save the installed virt-tests-vm1 as golden image, and put its disk
+        on an overlay of it.
+        """
+        print 'Saving golden image to %s' % golden_dir
+        sys.stdout.flush()
+        if not os.path.isdir(golden_dir):
+            os.makedirs(golden_dir)
+        domain_xml = virsh.dumpxml('virt-tests-vm1',
+                                   extra='--inactive').stdout
+        disk = self.golden_disk(domain_xml)
+        base = os.path.join(golden_dir, 'base.qcow2')
+        utils.run('qemu-img convert -O qcow2 %s %s.tmp' % (disk, base))
+        os.rename(base + '.tmp', base)
+        os.chmod(base, 0444)
+        # domain.xml is written last and marks the golden image complete
+        with open(os.path.join(golden_dir, 'domain.xml.tmp'), 'w') as fp:
+            fp.write(domain_xml)
+        os.rename(os.path.join(golden_dir, 'domain.xml.tmp'),
+                  os.path.join(golden_dir, 'domain.xml'))
+        self.golden_dir = golden_dir
+        self.create_overlay(disk)
+
+    def define_golden_vm(self):
+        """
+        Define virt-tests-vm1 on a new overlay of the golden image.
+        """
+        domain_file = os.path.join(self.golden_dir, 'domain.xml')
+        with open(domain_file) as fp:
+            self.create_overlay(self.golden_disk(fp.read()))
+        res = virsh.define(domain_file, uri=self.args.connect_uri or None)
+        if res.exit_status:
+            raise Exception('   ERROR: Failed to define guest \n %s' % res)
+
+    def clone_vm(self, original, name):
+        """
+        Clone a guest with its storage.
+
+        With a golden image, the clone gets a new overlay instead of a full
+        copy of the disk of _original_.
+        """
+        cmd = 'virt-clone '
+        if self.args.connect_uri:
+            cmd += '--connect=%s ' % self.args.connect_uri
+        if self.golden_dir:
+            domain_file = os.path.join(self.golden_dir, 'domain.xml')
+            with open(domain_file) as fp:
+                disk = self.golden_disk(fp.read())
+            overlay = os.path.join(os.path.dirname(disk), '%s.qcow2' % name)
+            self.create_overlay(overlay)
+            cmd += '--original-xml=%s ' % domain_file
+            cmd += '--name=%s ' % name
+            cmd += '--file=%s --preserve-data' % overlay
+        else:
+            cmd += '--original=%s ' % original
+            cmd += '--name=%s ' % name
+            cmd += '--auto-clone'
+        utils.run(cmd)
+
+    def main_config(self):
+        """
+        Return absolute path of the Cartesian config tests run with.
+        """
+        config = self.args.config
+        if not config:
+            config = os.path.join(self.root_dir, 'backends', 'libvirt', 'cfg', 'tests.cfg')
+        return os.path.abspath(config)
+
+    def start_warm_runner(self):
+        """
+        Start the warm runner for tests run outside worker slots.
+        """
+        if not self.args.warm_runner or self.slots:
+            return
+        print 'Starting warm runner'
+        sys.stdout.flush()
+        runner = WarmRunner(
+            self.root_dir, os.path.join(self.log_dir, 'warm-runner.log'),
+            config=self.main_config(), provider_dir=self.provider_dir(),
+            memo_config=self.args.cfg_memo)
+        if runner.start():
+            self.warm_runner = runner
+        else:
+            print 'Warning: warm runner failed to start, see %s' % (
+                runner.log_path)
+
+    def prepare_vm_snapshots(self):
+        """
+        Snapshot test VMs for --vm-snapshot.
+        """
+        if self.args.vm_snapshot == 'off':
+            return
+        if self.slots:
+            print 'Warning: --vm-snapshot is ignored with worker slots'
+            return
+        vms = ['virt-tests-vm1']
+        if self.args.add_vms:
+            vms += self.args.add_vms.split(',')
+        for vm in vms:
+            snapshot = VMSnapshot(
+                vm, os.path.join(self.args.cache_dir, 'vm-snapshots',
+                                 vm + '.xml'),
+                uri=self.args.connect_uri or None)
+            try:
+                snapshot.create()
+            except Exception, e:
+                print 'Warning: Failed to snapshot %s: %s' % (vm, e)
+                continue
+            self.vm_snapshots.append(snapshot)
 
-    def run_test(self, test, restore_image=False, check=True, recover=True):
+    def prepare_slots(self):
+        """
+        Provision worker slots for running tests in parallel.
+        """
+        self.slots = []
+        jobs = int(self.args.jobs)
+        if jobs <= 1:
+            return
+        vms = ['virt-tests-vm1']
+        if self.args.add_vms:
+            vms += self.args.add_vms.split(',')
+        config = self.main_config()
+        for index in range(jobs):
+            slot = WorkerSlot(index, vms, config)
+            print 'Preparing worker slot %d' % index
+            sys.stdout.flush()
+            slot.remove_vms()
+            for vm in vms:
+                self.clone_vm(vm, slot.vm_map[vm])
+            slot.prepare()
+            self.slots.append(slot)
+
+    def run_test(self, test, restore_image=False, check=True, recover=True,
+                 slot=None):
         """
         Run a specific test.
+
+        When a worker slot is given, the test runs on the VMs of the slot
+        and the result is not printed.
         """
         img_str = '' if restore_image else 'k'
-        down_str = '' if restore_image else '--no-downloads'
-        cmd = './run -v%st libvirt --keep-image-between-tests %s --tests %s' % (
-            img_str, down_str, test)
+        argv = ['-v%st' % img_str, 'libvirt', '--keep-image-between-tests']
+        if not restore_image:
+            argv.append('--no-downloads')
+        argv += ['--tests', test]
         if self.args.connect_uri:
-            cmd += ' --connect-uri %s' % self.args.connect_uri
+            argv += ['--connect-uri', self.args.connect_uri]
         status = 'INVALID'
-        try:
-            res = utils.run(cmd, timeout=int(self.args.timeout),
-                            ignore_status=True)
-            lines = res.stdout.splitlines()
-            for line in lines:
-                if line.startswith('(1/1)'):
-                    status = line.split()[2]
-        except error.CmdError, e:
-            res = e.result_obj
+        timeout = self.test_timeout(test)
+        idle_timeout = int(self.args.idle_timeout)
+        with self.tracer.span('./run', test=test):
+            if slot is None and self.warm_runner is not None:
+                monitor = OutputMonitor(self.log_path(test),
+                                        self.fatal_patterns,
+                                        merged=True, tee=False)
+                res = self.run_warm(argv, timeout, monitor, idle_timeout)
+            else:
+                cmd = ' '.join(['./run'] + argv)
+                if slot is not None:
+                    cmd = slot.wrap_cmd(cmd)
+                monitor = OutputMonitor(self.log_path(test),
+                                        self.fatal_patterns)
+                res = self.run_streaming(cmd, timeout, monitor, idle_timeout)
+        for _, _, _, test_status, _ in monitor.statuses:
+            status = test_status
+        abort_msg = []
+        if res.abort_reason == 'timeout':
             status = 'TIMEOUT'
-            res.duration = int(self.args.timeout)
-        except Exception, e:
-            print "Exception when parsing stdout.\n%s" % res
-            raise e
+            abort_msg.append('Killed after timeout of %d s' % timeout)
+        elif res.abort_reason == 'idle':
+            status = 'TIMEOUT'
+            abort_msg.append('Killed after no output for %s s' %
+                             self.args.idle_timeout)
+        elif res.abort_reason == 'fatal':
+            status = 'ERROR'
+            abort_msg.append('Killed on fatal output: %s' % monitor.fatal)
 
-        os.chdir(data_dir.get_root_dir())  # Check PWD
+        os.chdir(self.root_dir)  # Check PWD
 
-        err_msg = []
+        err_msg = abort_msg
 
+        timings = None
         if check:
-            diff = False
-            for state in self.states:
-                diffmsg = state.check(recover=recover)
-                if diffmsg:
-                    if not diff:
-                        diff = True
-                        status += ' DIFF'
-                    for line in diffmsg:
-                        err_msg.append('   DIFF|%s' % line)
+            diffmsg, timings = self.check_states(
+                recover=recover, test=test,
+                dirty=status.split()[0] not in ('PASS', 'SKIP'))
+            if diffmsg:
+                status += ' DIFF'
+                for line in diffmsg:
+                    err_msg.append('   DIFF|%s' % line)
+
+        self.add_output_messages(status, res, err_msg)
+        if slot is None:
+            self.print_result(status, res, err_msg, timings)
+        return status, res, err_msg
 
-        print 'Result: %s %.2f s' % (status, res.duration)
+    def add_output_messages(self, status, res, err_msg):
+        """
+        Add error lines or the output tail of a failed test to _err_msg_.
 
-        if 'FAIL' in status or 'ERROR' in status:
-            for line in res.stderr.splitlines():
-                if 'ERROR' in line:
-                    err_msg.append('  %s' % line[9:])
-        if status == 'INVALID' or status == 'TIMEOUT':
+        Merged output holds the whole debug log, so only its error lines
+        are added.
+        """
+        broken = status == 'INVALID' or status == 'TIMEOUT'
+        if 'FAIL' in status or 'ERROR' in status or (broken and res.merged):
+            for line in res.errors:
+                err_msg.append('  %s' % line[9:])
+        if broken and not res.merged:
             for line in res.stdout.splitlines():
                 err_msg.append(line)
+
+    def batch_groups(self, tests, batch_size):
+        """
+        Split tests into groups of consecutive tests of the same class,
+        each holding at most _batch_size_ tests.
+        """
+        groups = []
+        last_class = None
+        for test in tests:
+            class_name, _ = self.split_name(test)
+            if (not groups or class_name != last_class or
+                    len(groups[-1]) >= batch_size):
+                groups.append([])
+            groups[-1].append(test)
+            last_class = class_name
+        return groups
+
+    def run_batch(self, tests):
+        """
+        Run several tests with a single ./run invocation.
+
+        Statuses and durations of tests are taken from the (i/n) lines of
+        ./run, and the output of every test goes to its own log.
+
+        :return: A list of (status, res, err_msg) for each test, None for
+                 tests whose status was never printed or not matched.
+        """
+        argv = ['-vkt', 'libvirt', '--keep-image-between-tests',
+                '--no-downloads', '--tests', ','.join(tests)]
+        if self.args.connect_uri:
+            argv += ['--connect-uri', self.args.connect_uri]
+        monitor = BatchMonitor(tests,
+                               [self.log_path(test) for test in tests],
+                               self.fatal_patterns)
+        timeout = sum(self.test_timeout(test) for test in tests)
+        idle_timeout = int(self.args.idle_timeout)
+        with self.tracer.span('run_batch', tests=len(tests)):
+            if self.warm_runner is not None:
+                batch_res = self.run_warm(
+                    argv, timeout, monitor, idle_timeout,
+                    log_path=os.path.join(self.log_dir, 'warm-batch.log'))
+                cmd = batch_res.command
+            else:
+                cmd = ' '.join(['./run'] + argv) + ' 2>&1'
+                batch_res = self.run_streaming(cmd, timeout, monitor,
+                                               idle_timeout)
+        os.chdir(self.root_dir)  # Check PWD
+
+        results = []
+        for test, test_monitor in zip(tests, monitor.monitors):
+            if test_monitor is None:
+                results.append(None)
+                continue
+            _, _, _, status, duration = test_monitor.statuses[-1]
+            res = StreamResult(cmd, test_monitor, batch_res.exit_status,
+                               duration or 0.0)
+            err_msg = []
+            self.add_output_messages(status, res, err_msg)
+            results.append((status, res, err_msg))
+        return results
+
+    def run_states(self, func, phase='check'):
+        """
+        Run _func_ on every state and return results and durations keyed
+        by state, tracing it as _phase_ of each state.
+
+        Ordered states run one by one first, then the others run
+        concurrently in threads.
+        """
+        results = {}
+        timings = {}
+
+        def run_state(state):
+            start = time.time()
+            try:
+                with self.tracer.span('%s.%s' % (state.name, phase)):
+                    results[state] = func(state)
+            except Exception:
+                traceback.print_exc()
+                results[state] = ['Failed to check %s:\n %s' % (
+                    state.name, traceback.format_exc())]
+            timings[state] = timings.get(state, 0) + time.time() - start
+
+        for state in self.states:
+            if state.ordered:
+                run_state(state)
+        threads = []
+        for state in self.states:
+            if not state.ordered:
+                thread = threading.Thread(target=run_state, args=(state,))
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results, timings
+
+    def backup_states(self):
+        """
+        Backup all states.
+        """
+        self.run_states(lambda state: state.backup(), 'backup')
+
+    def reset_vms(self, vm_actions, test, dirty):
+        """
+        Reset snapshot VMs, by reverting them or by running their restore
+        actions _vm_actions_.
+
+        VMs are reverted after every test with --vm-snapshot always, and
+        after tests that did not pass. Otherwise changed VMs are reset by
+        whichever method was faster for _test_, and the duration of the
+        reset is recorded for it.
+
+        :return: A tuple of the reset method, None if VMs were left alone,
+                 its duration and messages of failed reverts.
+        """
+        if self.args.vm_snapshot == 'always' or dirty:
+            method = 'revert'
+        elif vm_actions:
+            method = self.history.cheaper_reset(test) if test else 'revert'
+        else:
+            return None, None, []
+        start = time.time()
+        messages = []
+        if method == 'revert':
+            for snapshot in self.vm_snapshots:
+                try:
+                    snapshot.revert()
+                except Exception, e:
+                    traceback.print_exc()
+                    messages.append('Revert is failed:\n %s' % e)
+        if method == 'repair' or messages:
+            # Repair, or fall back to it
+            planner = RestorePlanner()
+            planner.actions = list(vm_actions)
+            planner.execute()
+        duration = time.time() - start
+        if vm_actions and test and not messages:
+            self.history.record_reset(test, method, duration)
+        return method, duration, messages
+
+    def check_states(self, recover=True, test=None, dirty=False):
+        """
+        Check state changes of all states.
+
+        Ordered states are checked and recovered first. Other states are
+        collected and diffed concurrently, adding their restore actions to
+        a RestorePlanner, which then runs them in dependency order.
+
+        With --vm-snapshot, restore actions of snapshot VMs are taken out
+        of the planner and the VMs are reset after it by reset_vms().
+
+        :return: A tuple of diff messages and a list of (state name,
+                 duration) tuples, restores are timed as "restore" and
+                 VM resets by their method.
+        """
+        planner = RestorePlanner()
+
+        def check(state):
+            if state.ordered:
+                return state.check(recover=recover)
+            return state.check(recover=recover, planner=planner)
+
+        with self.tracer.span('check_states'):
+            results, timings = self.run_states(check)
+        timings = [(state.name, timings[state]) for state in self.states]
+        reset = self.vm_snapshots and recover
+        vm_actions = []
+        if reset:
+            vms = set(snapshot.vm for snapshot in self.vm_snapshots)
+            actions = planner.actions
+            planner.actions = []
+            for action in actions:
+                if (isinstance(action[0], DomainState) and
+                        (action[2] or action[3])['name'] in vms):
+                    vm_actions.append(action)
+                else:
+                    planner.actions.append(action)
+        if planner.actions:
+            start = time.time()
+            with self.tracer.span('restore', actions=len(planner.actions)):
+                planner.execute()
+            timings.append(('restore', time.time() - start))
+        messages = []
+        if reset:
+            with self.tracer.span('reset_vms'):
+                method, duration, messages = self.reset_vms(
+                    vm_actions, test, dirty)
+            if method is not None:
+                timings.append((method, duration))
+        diffmsg = []
+        for state in self.states:
+            diffmsg += results[state]
+        diffmsg += messages
+        return diffmsg, timings
+
+    def log_path(self, test):
+        """
+        Return path of the log file of a test.
+        """
+        name = test
+        if len(name) > 200:
+            name = '%s-%s' % (name[:150], hashlib.sha1(name).hexdigest())
+        return os.path.join(self.log_dir, name + '.log')
+
+    def test_timeout(self, test):
+        """
+        Return timeout of a test.
+
+        Tests with enough passed runs in history time out after a multiple
+        of their 95th percentile duration, but never later than --timeout.
+        """
+        timeout = int(self.args.timeout)
+        factor = float(self.args.history_timeout)
+        p95 = self.history.percentile(test, 95)
+        if factor > 0 and p95 is not None:
+            timeout = min(timeout, max(int(p95 * factor),
+                                       int(self.args.min_timeout)))
+        return timeout
+
+    def run_streaming(self, cmd, timeout, monitor, idle_timeout=0):
+        """
+        Run a command, feeding its output lines to _monitor_ as they come.
+
+        The command runs in its own process group, which is killed at once
+        when it does not finish in _timeout_ seconds, prints nothing for
+        _idle_timeout_ seconds or prints a line matching a fatal pattern
+        of the monitor.
+
+        Children left by the command may keep its output open, so output
+        is only read for _drain_timeout_ seconds after the command exited.
+        """
+        start = time.time()
+        last_output = start
+        exited = None
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, close_fds=True,
+                                preexec_fn=os.setsid)
+        streams = {proc.stdout.fileno(): False, proc.stderr.fileno(): True}
+        partial = dict((fd, '') for fd in streams)
+        abort_reason = None
+        try:
+            while streams:
+                if exited is None and proc.poll() is not None:
+                    exited = time.time()
+                if exited is None:
+                    abort_reason = self.abort_reason(
+                        start, timeout, last_output, idle_timeout, monitor)
+                    if abort_reason:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                        break
+                    wait = max(start + timeout - time.time(), 0)
+                else:
+                    wait = exited + self.drain_timeout - time.time()
+                    if wait <= 0:
+                        break
+                readable, _, _ = select.select(list(streams), [], [],
+                                               min(wait, 1.0))
+                if readable:
+                    last_output = time.time()
+                for fd in readable:
+                    data = os.read(fd, 65536)
+                    if not data:
+                        if partial[fd]:
+                            monitor.feed(partial[fd], streams[fd])
+                        del streams[fd]
+                        continue
+                    lines = (partial[fd] + data).split('\n')
+                    partial[fd] = lines.pop()
+                    for line in lines:
+                        monitor.feed(line, streams[fd])
+            exit_status = proc.wait()
+        finally:
+            proc.stdout.close()
+            proc.stderr.close()
+            monitor.close()
+        return StreamResult(cmd, monitor, exit_status, time.time() - start,
+                            abort_reason)
+
+    def abort_reason(self, start, timeout, last_output, idle_timeout,
+                     monitor):
+        """
+        Return why a running command should be killed, or None.
+        """
+        now = time.time()
+        if now - start >= timeout:
+            return 'timeout'
+        elif idle_timeout and now - last_output > idle_timeout:
+            return 'idle'
+        elif monitor.fatal is not None:
+            return 'fatal'
+        return None
+
+    def run_warm(self, argv, timeout, monitor, idle_timeout=0,
+                 log_path=None):
+        """
+        Run ./run with _argv_ in the warm runner, like run_streaming().
+
+        The child writes its merged output to _log_path_, default to the
+        log of the monitor, and lines are fed to _monitor_ as the log
+        grows.
+        """
+        if log_path is None:
+            log_path = monitor.log_path
+        command = ' '.join(['./run'] + argv)
+        start = time.time()
+        last_output = start
+        sock, pid = self.warm_runner.submit(argv, log_path, self.root_dir)
+        abort_reason = None
+        partial = ''
+        exit_status = None
+        try:
+            with open(log_path) as log:
+                done = False
+                while not done:
+                    abort_reason = self.abort_reason(
+                        start, timeout, last_output, idle_timeout, monitor)
+                    if abort_reason:
+                        try:
+                            os.killpg(pid, signal.SIGKILL)
+                        except OSError:
+                            os.kill(pid, signal.SIGKILL)
+                        break
+                    # The exit reply comes after the child wrote all output
+                    readable, _, _ = select.select([sock], [], [], 0.1)
+                    done = bool(readable)
+                    data = log.read()
+                    if not data:
+                        continue
+                    last_output = time.time()
+                    lines = (partial + data).split('\n')
+                    partial = lines.pop()
+                    for line in lines:
+                        monitor.feed(line)
+                if partial:
+                    monitor.feed(partial)
+            exit_status = self.warm_runner.wait(sock)
+        finally:
+            sock.close()
+            monitor.close()
+        return StreamResult(command, monitor, exit_status,
+                            time.time() - start, abort_reason)
+
+    def print_result(self, status, res, err_msg, timings=None):
+        """
+        Print the result of a test.
+        """
+        print 'Result: %s %.2f s' % (status, res.duration)
+        if timings:
+            print '   State check: %s' % ', '.join(
+                '%s %.2f s' % timing for timing in timings)
         if err_msg:
             for line in err_msg:
                 print line
         sys.stdout.flush()
-        return status, res, err_msg
+
+    def run_serial(self, tests, report):
+        """
+        Run tests one by one, or group by group in batch mode.
+        """
+        batch_size = int(self.args.batch_size)
+        if batch_size > 1:
+            groups = self.batch_groups(tests, batch_size)
+        else:
+            groups = [[test] for test in tests]
+        idx = 0
+        for group in groups:
+            if len(group) > 1:
+                self.run_group(group, report, idx, len(tests))
+                idx += len(group)
+                continue
+            test = group[0]
+            short_name = test.split('.', 2)[2]
+            print '%s (%d/%d) %s ' % (time.strftime('%X'), idx + 1,
+                                      len(tests), short_name),
+            sys.stdout.flush()
+
+            status, res, err_msg = self.run_test(
+                test,
+                check=not self.args.no_check,
+                recover=not self.args.no_recover)
+
+            self.update_report(report, test, status, res, err_msg)
+            idx += 1
+
+    def run_group(self, tests, report, offset, total):
+        """
+        Run a group of tests in a batch, checking states once after it.
+
+        If the group changed states, or some test has no status, those
+        tests are run again one by one with states checked after each.
+        """
+        print '%s Running batch of %d tests of %s' % (
+            time.strftime('%X'), len(tests), self.split_name(tests[0])[0])
+        sys.stdout.flush()
+        results = self.run_batch(tests)
+        isolate = [test for test, result in zip(tests, results)
+                   if result is None]
+        if not self.args.no_check:
+            diffmsg, timings = self.check_states(
+                recover=not self.args.no_recover,
+                dirty=bool([result for result in results if result is None or
+                            result[0] not in ('PASS', 'SKIP')]))
+            print '   State check: %s' % ', '.join(
+                '%s %.2f s' % timing for timing in timings)
+            if diffmsg:
+                print '   Batch changed states, running tests one by one'
+                for line in diffmsg:
+                    print '   DIFF|%s' % line
+                isolate = tests
+        if isolate:
+            print '   Isolating %d tests' % len(isolate)
+
+        for idx, (test, result) in enumerate(zip(tests, results)):
+            short_name = test.split('.', 2)[2]
+            print '%s (%d/%d) %s ' % (time.strftime('%X'), offset + idx + 1,
+                                      total, short_name),
+            sys.stdout.flush()
+            if test in isolate:
+                status, res, err_msg = self.run_test(
+                    test,
+                    check=not self.args.no_check,
+                    recover=not self.args.no_recover)
+            else:
+                status, res, err_msg = result
+                self.print_result(status, res, err_msg)
+            self.update_report(report, test, status, res, err_msg)
+
+    def run_parallel(self, tests, report):
+        """
+        Dispatch tests to free worker slots and merge results to report.
+
+        States are checked once after all tests finished, since changes
+        on the host could not be attributed to a single test. The slots
+        are cleaned up afterwards, even if the run is interrupted.
+        """
+        try:
+            test_queue = Queue.Queue()
+            result_queue = Queue.Queue()
+            for test in tests:
+                test_queue.put(test)
+
+            def worker(slot):
+                while True:
+                    try:
+                        test = test_queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        status, res, err_msg = self.run_test(
+                            test, check=False, recover=False, slot=slot)
+                    except Exception:
+                        res = utils.CmdResult(command=test,
+                                              stderr=traceback.format_exc(),
+                                              exit_status=1)
+                        status, err_msg = 'ERROR', res.stderr.splitlines()
+                    result_queue.put((test, status, res, err_msg))
+
+            threads = []
+            for slot in self.slots:
+                thread = threading.Thread(target=worker, args=(slot,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+            for idx in range(len(tests)):
+                test, status, res, err_msg = result_queue.get()
+                short_name = test.split('.', 2)[2]
+                print '%s (%d/%d) %s ' % (time.strftime('%X'), idx + 1,
+                                          len(tests), short_name),
+                self.print_result(status, res, err_msg)
+                self.update_report(report, test, status, res, err_msg)
+
+            for thread in threads:
+                thread.join()
+
+            if not self.args.no_check:
+                diffmsg, _ = self.check_states(
+                    recover=not self.args.no_recover)
+                for line in diffmsg:
+                    print '   DIFF|%s' % line
+                sys.stdout.flush()
+        finally:
+            for slot in self.slots:
+                slot.cleanup()
+
+    def resume(self, tests, report):
+        """
+        Keep results of completed tests in the report journal and return
+        tests not yet completed.
+        """
+        names = set(self.split_name(test) for test in tests)
+        done = report.resume_journal(lambda *key: key in names)
+        print 'Resuming run, %d of %d tests already completed' % (
+            len(done), len(tests))
+        return [test for test in tests if self.split_name(test) not in done]
+
+    def update_report(self, report, test, status, res, err_msg):
+        """
+        Insert the result of a test into report.
+        """
+        class_name, test_name = self.split_name(test)
+
+        report.update(test_name, class_name, status,
+                      res.stderr, err_msg, res.duration)
+        self.history.record(test, status, res.duration)
+        if not report.journal:
+            with self.tracer.span('report.save'):
+                report.save(self.args.report)
 
     def prepare_repos(self):
         """
         Prepare repos for the tests.
         """
-        def merge_pulls(repo_name, pull_nos):
-            branch_name = ','.join(pull_nos)
-            cmd = 'git checkout -b %s' % branch_name
-            res = utils.run(cmd, ignore_status=True)
-            if res.exit_status:
-                print res
-                raise Exception('Failed to create branch %s' % branch_name)
+        def apply_pulls(path, repo_name, pull_nos):
+            def fetch_patch(pull_no):
+                if github.pr_open(repo_name, pull_no):
+                    return github.patch(repo_name, pull_no)
+                return None
 
-            for pull_no in pull_nos:
-                if pr_open(repo_name, pull_no):
-                    patch_url = ('https://github.com/autotest'
-                                 '/%s/pull/%s.patch' % (repo_name, pull_no))
+            patches = github.fetch_all(fetch_patch, pull_nos)
+            for pull_no, patch in zip(pull_nos, patches):
+                if patch is not None:
                     patch_file = "/tmp/%s.patch" % pull_no
                     with open(patch_file, 'w') as pf:
-                        pf.write(urllib2.urlopen(patch_url).read())
-                    with open(patch_file, 'r') as pf:
-                        if not pf.read().strip():
-                            print 'WARING: empty content for PR #%s' % pull_no
+                        pf.write(patch)
+                    if not patch.strip():
+                        print 'WARING: empty content for PR #%s' % pull_no
                     try:
                         print 'Patching %s PR #%s' % (repo_name, pull_no)
-                        cmd = 'git am -3 %s' % patch_file
+                        cmd = 'cd %s && git am -3 %s' % (path, patch_file)
                         res = utils.run(cmd)
                     except error.CmdError, e:
                         print e
                         raise Exception('Failed applying patch %s.' % pull_no)
                     finally:
                         os.remove(patch_file)
-            return branch_name
 
-        def file_changed(repo_name):
-            cmd = 'git diff master --name-only'
+        def head_commit(repo_dir):
+            cmd = 'cd %s && git rev-parse HEAD' % repo_dir
+            res = utils.run(cmd, ignore_status=True)
+            if res.exit_status:
+                print res
+                raise Exception('Failed to get HEAD of %s' % repo_dir)
+            return res.stdout.strip()
+
+        def file_changed(path, base):
+            cmd = 'cd %s && git diff %s --name-only' % (path, base)
             res = utils.run(cmd, ignore_status=True)
             if res.exit_status:
                 print res
-                raise Exception("Failed to get diff info against master")
+                raise Exception("Failed to get diff info against %s" % base)
 
             return res.stdout.strip().splitlines()
 
@@ -1217,45 +5080,31 @@ class LibvirtCI():
             res |= set(match)
             return res
 
-        def pr_open(repo_name, pr_number):
-            oauth = ('?client_id=b6578298435c3eaa1e3d&client_secret'
-                     '=59a1c828c6002ed4e8a9205486cf3fa86467a609')
-            issues_url = 'https://api.github.com/repos/autotest/%s/issues/' % repo_name
-            issue_url = issues_url + pr_number + oauth
-            issue_u = urllib2.urlopen(issue_url)
-            issue = json.load(issue_u)
-            return issue['state'] == 'open'
-
         def libvirt_pr_dep(pr_numbers):
-            oauth = ('?client_id=b6578298435c3eaa1e3d&client_secret'
-                     '=59a1c828c6002ed4e8a9205486cf3fa86467a609')
+            def fetch_bodies(pr_number):
+                # PR's first comment and other comments
+                issue = github.issue('tp-libvirt', pr_number)
+                comments = github.comments('tp-libvirt', pr_number)
+                return [issue['body'] or ''] + [comment['body'] or ''
+                                                for comment in comments]
+
             dep = set()
-            for pr_number in pr_numbers:
-                # Find PR's first comment for dependencies.
-                issues_url = 'https://api.github.com/repos/autotest/tp-libvirt/issues/'
-                issue_url = issues_url + pr_number + oauth
-                issue_u = urllib2.urlopen(issue_url)
-                issue = json.load(issue_u)
-                for line in issue['body'].splitlines():
-                    dep |= search_dep(line)
-
-                # Find PR's other comments for dependencies.
-                comments_url = issues_url + '%s/comments' % pr_number + oauth
-                comments_u = urllib2.urlopen(comments_url)
-                comments = json.load(comments_u)
-                for comment in comments:
-                    for line in comment['body'].splitlines():
+            for bodies in github.fetch_all(fetch_bodies, pr_numbers):
+                for body in bodies:
+                    for line in body.splitlines():
                         dep |= search_dep(line)
 
             # Remove closed dependences:
-            pruned_dep = set()
-            for pr_number in dep:
-                if pr_open('virt-test', pr_number):
-                    pruned_dep.add(pr_number)
-
-            return pruned_dep
+            dep = sorted(dep)
+            states = github.fetch_all(
+                lambda pr_number: github.pr_open('virt-test', pr_number), dep)
+            return set(pr_number for pr_number, is_open in zip(dep, states)
+                       if is_open)
 
-        self.virt_branch_name, self.libvirt_branch_name = None, None
+        github = GitHubClient(os.path.join(self.args.cache_dir, 'github'),
+                              api_url=self.args.github_api,
+                              web_url=self.args.github_url,
+                              ttl=int(self.args.github_ttl))
 
         libvirt_pulls = set()
         virt_test_pulls = set()
@@ -1269,43 +5118,45 @@ class LibvirtCI():
         if self.args.virt_test_pull:
             virt_test_pulls |= set(self.args.virt_test_pull.split(','))
 
-        if virt_test_pulls:
-            os.chdir(data_dir.get_root_dir())
-            self.virt_branch_name = merge_pulls("virt-test", virt_test_pulls)
+        self.virt_file_changed, self.libvirt_file_changed = [], []
+        if virt_test_pulls or libvirt_pulls:
+            tp_dir = data_dir.get_test_provider_dir(
+                'io-github-autotest-libvirt')
+            virt_base = head_commit(self.root_dir)
+            libvirt_base = head_commit(tp_dir)
+            layers = [
+                ('virt-test', self.root_dir, '', virt_base, virt_test_pulls),
+                ('tp-libvirt', tp_dir,
+                 os.path.relpath(tp_dir, self.root_dir), libvirt_base,
+                 libvirt_pulls)]
+            worktree = self.worktrees.checkout(layers, apply_pulls)
+            self.worktrees.sync(self.root_dir, worktree)
+            self.root_dir = worktree
             if self.args.only_change:
-                self.virt_file_changed = file_changed("virt-test")
+                if virt_test_pulls:
+                    self.virt_file_changed = file_changed(
+                        worktree, virt_base)
+                if libvirt_pulls:
+                    self.libvirt_file_changed = file_changed(
+                        self.provider_dir(), libvirt_base)
 
-        if libvirt_pulls:
-            os.chdir(data_dir.get_test_provider_dir(
-                'io-github-autotest-libvirt'))
-            self.libvirt_branch_name = merge_pulls("tp-libvirt", libvirt_pulls)
-            if self.args.only_change:
-                self.libvirt_file_changed = file_changed("tp-libvirt")
+        os.chdir(self.root_dir)
 
-        os.chdir(data_dir.get_root_dir())
+    def provider_dir(self):
+        """
+        Return the tp-libvirt directory tests are running from.
+        """
+        tp_dir = data_dir.get_test_provider_dir('io-github-autotest-libvirt')
+        return os.path.join(self.root_dir,
+                            os.path.relpath(tp_dir, data_dir.get_root_dir()))
 
     def restore_repos(self):
         """
-        Checkout master branch and remove test branch.
+        Release the worktree and remove least recently used worktrees.
         """
-        def restore_repo(branch_name):
-            cmd = 'git checkout master'
-            res = utils.run(cmd, ignore_status=True)
-            if res.exit_status:
-                print res
-            cmd = 'git branch -D %s' % branch_name
-            res = utils.run(cmd, ignore_status=True)
-            if res.exit_status:
-                print res
-
-        if self.virt_branch_name:
-            os.chdir(data_dir.get_root_dir())
-            restore_repo(self.virt_branch_name)
-
-        if self.libvirt_branch_name:
-            os.chdir(data_dir.get_test_provider_dir(
-                'io-github-autotest-libvirt'))
-            restore_repo(self.libvirt_branch_name)
+        self.worktrees.release()
+        if not self.args.no_restore_pull:
+            self.worktrees.prune(int(self.args.worktree_keep))
         os.chdir(data_dir.get_root_dir())
 
     def run(self):
@@ -1313,9 +5164,34 @@ class LibvirtCI():
         Run continuous integrate for virt-test test cases.
         """
         self.parse_args()
-        report = Report(self.args.fail_diff)
+        journal = None
+        if (self.args.stream_report or self.args.rebuild_report or
+                self.args.resume):
+            journal = self.args.report + '.journal'
+        report = Report(self.args.fail_diff, journal)
+        if self.args.rebuild_report:
+            os.chdir(data_dir.get_root_dir())
+            report.save(self.args.report)
+            return
+        if journal and not self.args.resume:
+            open(journal, 'w').close()
+        self.history = TestHistory(self.args.history)
+        self.log_dir = self.args.log_dir
+        self.fatal_patterns = FATAL_PATTERNS + self.args.fatal_patterns
+        self.root_dir = data_dir.get_root_dir()
+        self.worktrees = WorktreeCache(
+            os.path.join(self.args.cache_dir, 'worktrees'))
+        self.warm_runner = None
+        self.vm_snapshots = []
+        self.tracer = Tracer(enabled=bool(self.args.trace))
+        profiler = None
+        if self.args.profile:
+            # Only the main thread is profiled
+            profiler = cProfile.Profile()
+            profiler.enable()
         try:
-            self.prepare_repos()
+            with self.tracer.span('prepare_repos'):
+                self.prepare_repos()
             if self.args.pre_cmd:
                 print 'Running command line "%s" before test.' % self.args.pre_cmd
                 res = utils.run(self.args.pre_cmd, ignore_status=True)
@@ -1323,10 +5199,29 @@ class LibvirtCI():
                 for line in str(res).splitlines():
                     print line
             # service must put at first, or the result will be wrong.
-            self.states = [FileState(), ServiceState(), DirState(),
+            dir_state = DirState(
+                recursive=self.args.deep_dir_check,
+                backup_dir=os.path.join(self.args.cache_dir, 'dir-backup'),
+                backup_limit=int(self.args.dir_backup_limit))
+            mount_state = MountState(scope=[
+                path for path in self.args.mount_scope.split(',') if path])
+            self.states = [FileState(), ServiceState(), dir_state,
                            DomainState(), NetworkState(), PoolState(),
-                           SecretState(), MountState()]
-            tests = self.prepare_tests()
+                           SecretState(), mount_state]
+            if self.args.inotify:
+                if pyinotify is None:
+                    print 'Warning: pyinotify is missing, --inotify ignored'
+                else:
+                    for state in (self.states[0], dir_state):
+                        state.watcher = PathWatcher()
+            for state in self.states:
+                state.tracer = self.tracer
+            if libvirt is not None and not self.args.virsh_state:
+                snapshot = LibvirtSnapshot(self.args.connect_uri)
+                for state in self.states:
+                    state.snapshot = snapshot
+            with self.tracer.span('prepare_tests'):
+                tests = self.prepare_tests()
 
             if self.args.list:
                 for test in tests:
@@ -1339,26 +5234,28 @@ class LibvirtCI():
                 print "No test to run!"
                 return
 
-            self.prepare_env()
-            for state in self.states:
-                state.backup()
-
-            for idx, test in enumerate(tests):
-                short_name = test.split('.', 2)[2]
-                print '%s (%d/%d) %s ' % (time.strftime('%X'), idx + 1,
-                                          len(tests), short_name),
-                sys.stdout.flush()
-
-                status, res, err_msg = self.run_test(
-                    test,
-                    check=not self.args.no_check,
-                    recover=not self.args.no_recover)
-
-                class_name, test_name = self.split_name(test)
-
-                report.update(test_name, class_name, status,
-                              res.stderr, err_msg, res.duration)
-                report.save(self.args.report)
+            if self.args.resume:
+                tests = self.resume(tests, report)
+                if not tests:
+                    print 'All tests are completed'
+                    return
+
+            with self.tracer.span('prepare_env'):
+                self.prepare_env()
+            with self.tracer.span('prepare_slots'):
+                self.prepare_slots()
+            with self.tracer.span('prepare_vm_snapshots'):
+                self.prepare_vm_snapshots()
+            with self.tracer.span('backup_states'):
+                self.backup_states()
+            with self.tracer.span('start_warm_runner'):
+                self.start_warm_runner()
+
+            with self.tracer.span('tests', count=len(tests)):
+                if self.slots:
+                    self.run_parallel(tests, report)
+                else:
+                    self.run_serial(tests, report)
             if self.args.post_cmd:
                 print 'Running command line "%s" after test.' % self.args.post_cmd
                 res = utils.run(self.args.post_cmd, ignore_status=True)
@@ -1368,9 +5265,24 @@ class LibvirtCI():
         except Exception:
             traceback.print_exc()
         finally:
-            if not self.args.no_restore_pull:
+            if self.warm_runner is not None:
+                self.warm_runner.stop()
+            for snapshot in self.vm_snapshots:
+                snapshot.delete()
+            with self.tracer.span('restore_repos'):
                 self.restore_repos()
-            report.save(self.args.report)
+            with self.tracer.span('report.save'):
+                report.save(self.args.report)
+            self.history.save()
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.args.profile)
+                print 'Profile saved to %s' % self.args.profile
+            if self.args.trace:
+                self.tracer.save(self.args.trace)
+                print 'Trace saved to %s' % self.args.trace
+                for line in self.tracer.summary():
+                    print line
 
 
 def state_test():
@@ -1392,8 +5304,158 @@ def state_test():
             print line
 
 
+def history_test():
+    """
+    Check shards and history timeouts.
+    """
+    tests = ['virsh.t%d' % idx for idx in range(10)]
+    history = TestHistory(None)
+    for idx, test in enumerate(tests):
+        history.record(test, 'PASS', idx * 10.0)
+    for h in (history, TestHistory(None)):
+        shards = [h.shard(tests, index, 3) for index in range(3)]
+        print shards
+        assert sorted(sum(shards, [])) == sorted(tests), shards
+    for _ in range(5):
+        history.record('virsh.skip', 'SKIP', 0.5)
+    assert history.percentile('virsh.skip', 95) is None
+    for duration in (10.0, 20.0, 30.0, 40.0, 50.0):
+        history.record('virsh.skip', 'PASS', duration)
+    assert history.percentile('virsh.skip', 95) == 50.0
+
+
+def impact_test():
+    """
+    Check variant prefixes parsed from a tp-libvirt cfg file.
+    """
+    cfg = tempfile.NamedTemporaryFile(suffix='.cfg')
+    cfg.write('- virsh.domstate:\n'
+              '    type = virsh_domstate\n'
+              '    # type = commented\n'
+              '    variants:\n'
+              '        - @normal:\n'
+              '            variants:\n'
+              '                - running:\n'
+              '                    type = virsh_running\n'
+              '        - error:\n'
+              '            type = virsh_error\n')
+    cfg.flush()
+    results = ImpactIndex('', '').parse_cfg(cfg.name)
+    print results
+    assert results == [(None, 'virsh.domstate'),
+                       ('virsh_domstate', 'virsh.domstate'),
+                       ('virsh_running', 'virsh.domstate.running'),
+                       ('virsh_error', 'virsh.domstate.error')], results
+
+
+def batch_monitor_test():
+    """
+    Check output of a batch is split by status lines in any order.
+    """
+    log_dir = tempfile.mkdtemp()
+    try:
+        tests = ['virsh.a', 'virsh.b', 'virsh.c']
+        log_paths = [os.path.join(log_dir, test + '.log') for test in tests]
+        monitor = BatchMonitor(tests, log_paths)
+        for line in ['output of b',
+                     '(1/3) type_specific.virsh.b: PASS (1.00 s)',
+                     'output of a', '12:00:00 ERROR| a failed',
+                     '(2/3) type_specific.virsh.a: FAIL (2.00 s)',
+                     'output of c', 'and the end of it']:
+            monitor.feed(line)
+        monitor.close()
+        print [m and m.statuses for m in monitor.monitors]
+        assert monitor.monitors[2] is None
+        assert monitor.monitors[0].statuses[-1][3] == 'FAIL'
+        assert monitor.monitors[0].errors == ['12:00:00 ERROR| a failed']
+        assert monitor.monitors[1].statuses[-1][3] == 'PASS'
+        with open(log_paths[1]) as fp:
+            assert fp.read().startswith('output of b\n')
+        assert sorted(os.listdir(log_dir)) == ['virsh.a.log', 'virsh.b.log']
+    finally:
+        shutil.rmtree(log_dir)
+
+
+def planner_test():
+    """
+    Check restore levels of a domain on a pool at a mount point.
+    """
+    def pool_xml(path):
+        return ['<pool type="dir">', '<target><path>%s</path></target>' % path,
+                '</pool>']
+
+    mount_state, pool_state, domain_state = (
+        MountState(), PoolState(), DomainState())
+    mount = MountItem(mount_id='30', parent_id='1', src='nfs:/export',
+                      mount_point='/mnt/nfs', fstype='nfs', options='rw')
+    sub_mount = MountItem(mount_id='31', parent_id='30', src='tmpfs',
+                          mount_point='/mnt/nfs/tmp', fstype='tmpfs',
+                          options='rw')
+    pool = PoolItem(name='nfs', **{'inactive xml': pool_xml('/mnt/nfs')})
+    other_pool = PoolItem(name='images',
+                          **{'inactive xml': pool_xml('/var/images')})
+    domain = DomainItem(name='vm1', **{'inactive xml': [
+        '<domain><devices><disk><source file="/mnt/nfs/vm1.qcow2"/>',
+        '</disk></devices></domain>']})
+    planner = RestorePlanner()
+    for state, item in ((domain_state, domain), (pool_state, pool),
+                        (pool_state, other_pool), (mount_state, sub_mount),
+                        (mount_state, mount)):
+        planner.add(state, 'restore', item, None, [])
+    levels = [sorted(action[2].get('name') or action[2]['mount_point']
+                     for action in level)
+              for level in planner.levels(planner.actions)]
+    for level in levels:
+        print level
+    assert levels == [['/mnt/nfs', 'images'], ['nfs'],
+                      ['/mnt/nfs/tmp', 'vm1']], levels
+
+
+def snapshot_test():
+    xml = '<domain>\n  <name>vm1</name>\n</domain>\n'
+    dom = FakeLibvirtObject(
+        info=[5, 1048576, 1048576, 2, 0], isActive=0, ID=-1, name='vm1',
+        UUIDString='c7a5fdbd-edaf-9455-926a-d65c16db1809', OSType='hvm',
+        isPersistent=1, autostart=0, hasManagedSaveImage=0, XMLDesc=xml)
+    vol = FakeLibvirtObject(name='vol1', path='/images/vol1')
+    pool = FakeLibvirtObject(
+        info=[2, 10737418240, 1073741824, 9663676416], isActive=1,
+        name='default', UUIDString='3e4d7a5b-1c4e-4d6f-8a2b-6c0d3f4e5a6b',
+        isPersistent=1, autostart=1, listAllVolumes=[vol],
+        XMLDesc='<pool type="dir">\n</pool>\n')
+    conn = FakeLibvirtConnection(domains=[dom], pools=[pool])
+    snapshot = LibvirtSnapshot(connect=lambda uri: conn)
+    states = [DomainState(), PoolState()]
+    for state in states:
+        state.snapshot = snapshot
+        state.backup()
+    dom.props['autostart'] = 1
+    vol2 = FakeLibvirtObject(name='vol2', path='/images/vol2')
+    pool.props['listAllVolumes'] = [vol, vol2]
+    for state in states:
+        lines = state.check(recover=False)
+        for line in lines:
+            print line
+
+
+def warm_runner_daemon(options):
+    """
+    Serve as the daemon of a WarmRunner started by LibvirtCI.
+    """
+    options = dict(
+        (str(key), value.encode('utf-8') if isinstance(value, unicode)
+         else value) for key, value in json.loads(options).items())
+    socket_path = options.pop('socket_path')
+    runner = WarmRunner(log_path=None, **options)
+    runner.socket_path = socket_path
+    runner.serve()
+
+
 if __name__ == '__main__':
-    ci = LibvirtCI()
-    ci.run()
+    if len(sys.argv) > 2 and sys.argv[1] == '--warm-runner-daemon':
+        warm_runner_daemon(sys.argv[2])
+    else:
+        ci = LibvirtCI()
+        ci.run()
 
 # vi:set ts=4 sw=4 expandtab: